@@ -1,118 +1,428 @@
+import asyncio
+from contextlib import suppress
+
 from aiohttp import web
 
 import config
+import db.migrations
 import db.models
-from db.sessions import get_async_session
+import db.notifications
+import db.passwords
+import db.privileges
+from db.crud_ops import Conflict, coalescing_stats
+from db.sessions import (
+    get_async_session,
+    is_memory_sqlite,
+    pool_stats,
+    warm_pool,
+)
+from sqlalchemy import text
+
+from app import (
+    auth,
+    metrics,
+    profiling,
+    ratelimit,
+    response_cache,
+    shedding,
+    signed_tokens,
+)
+from app.json_backend import dumps
+from app.auth import (
+    check_config,
+    handle_revocation_notice,
+    invalidate_user_everywhere,
+    issue_token,
+    load_deny_list,
+    revoke_token,
+    run_token_sweeper,
+    token_cache,
+)
 from app.rest import (
+    read_json,
     validate,
+    validate_batch,
+    validate_body,
     get_object_by_field_or_404,
     get_object_or_404,
     check_token,
     check_access,
+    get_if_match,
+    json_response,
     paste_object,
+    paste_objects,
     raise_exception,
 )
 from validators.models import (
     Login,
     UserCreate,
-    ObjectId,
     RightCreate,
     PostCreate,
     PostUpdate,
+    PostList,
 )
 
 
 async def database_context(app: web.Application):
-    async with get_async_session(config.DB, create=True) as async_session_maker:
+    async with get_async_session(
+        config.DB, replica_dsn=config.DB_REPLICA
+    ) as async_session_maker:
+        if is_memory_sqlite(config.DB):
+            await db.migrations.apply_migrations(async_session_maker)
+        app["schema_version"] = await db.migrations.check_schema_version(
+            async_session_maker
+        )
         app["async_session_maker"] = async_session_maker
+        for engine in async_session_maker.engines:
+            await warm_pool(engine, config.DB_POOL_WARM)
+            metrics.instrument_engine(engine)
+            if config.SLOW_QUERY_SECONDS > 0:
+                profiling.instrument_slow_queries(engine)
         yield
 
 
+async def deny_list_context(app: web.Application):
+    await load_deny_list(app["async_session_maker"])
+    yield
+
+
+async def password_executor_context(app: web.Application):
+    app["password_executor"] = db.passwords.get_executor()
+    yield
+    db.passwords.shutdown_executor()
+
+
+async def notifications_context(app: web.Application):
+    listener = None
+    if db.notifications.is_postgres(config.DB):
+        listener = asyncio.create_task(
+            db.notifications.listen(
+                config.DB,
+                {
+                    db.privileges.CHANNEL: db.privileges.invalidate_group,
+                    auth.CHANNEL: auth.handle_invalidation_notice,
+                    signed_tokens.CHANNEL: handle_revocation_notice(
+                        app["async_session_maker"]
+                    ),
+                    response_cache.CHANNEL: response_cache.invalidate_post,
+                },
+            )
+        )
+    yield
+    if listener is not None:
+        listener.cancel()
+        with suppress(asyncio.CancelledError):
+            await listener
+
+
+async def token_sweeper_context(app: web.Application):
+    sweeper = asyncio.create_task(run_token_sweeper(app["async_session_maker"]))
+    yield
+    sweeper.cancel()
+    with suppress(asyncio.CancelledError):
+        await sweeper
+
+
 def get_session_maker(request: web.Request):
     return request.app["async_session_maker"]
 
 
+login_email_buckets = ratelimit.TokenBuckets(
+    config.LOGIN_RATE_PER_EMAIL,
+    config.LOGIN_BURST_PER_EMAIL,
+    config.LOGIN_RATE_LIMIT_SIZE,
+)
+login_ip_buckets = ratelimit.TokenBuckets(
+    config.LOGIN_RATE_PER_IP, config.LOGIN_BURST_PER_IP, config.LOGIN_RATE_LIMIT_SIZE
+)
+password_checks = ratelimit.ConcurrencyLimit(config.LOGIN_MAX_CONCURRENCY)
+
+
+def raise_too_many_requests(wait: float):
+    raise web.HTTPTooManyRequests(
+        text=dumps({"error": "too many login attempts"}).decode(),
+        content_type="application/json",
+        headers={"Retry-After": ratelimit.retry_after(wait)},
+    )
+
+
 async def login(request: web.Request):
-    login_data = validate(await request.json(), Login)
+    login_data = await validate_body(request, Login)
+    wait = max(
+        login_ip_buckets.take(request.remote),
+        login_email_buckets.take(login_data["email"].lower()),
+    )
+    if wait:
+        raise_too_many_requests(wait)
     user = await get_object_by_field_or_404(
         db.models.User, "email", login_data["email"], get_session_maker(request)
     )
-    if not user.check_password(login_data["password"]):
+    if not password_checks.try_acquire():
+        raise_too_many_requests(1)
+    rehashed = False
+    try:
+        password_is_correct = await user.check_password(login_data["password"])
+        if password_is_correct:
+            rehashed = await user.rehash_password(
+                login_data["password"], get_session_maker(request)
+            )
+    except db.passwords.ExecutorOverloaded:
+        raise_too_many_requests(1)
+    finally:
+        password_checks.release()
+    if not password_is_correct:
         raise_exception(web.HTTPUnauthorized, {"error": "wrong password"})
-    new_token = await db.models.AccessToken.create(get_session_maker(request), user)
-    return web.json_response(new_token.dict)
+    if rehashed:
+        await invalidate_user_everywhere(get_session_maker(request), user.id)
+    new_token = await issue_token(user, get_session_maker(request))
+    return json_response(new_token)
+
+
+@check_token
+async def logout(request: web.Request):
+    try:
+        await revoke_token(request.token, get_session_maker(request))
+    except signed_tokens.DenyListFull:
+        raise_exception(
+            web.HTTPServiceUnavailable, {"error": "too many revoked tokens"}
+        )
+    return json_response({"status": "OK"})
 
 
 @check_token
 async def create_user(request: web.Request):
-    user_data = validate(await request.json(), UserCreate)
+    user_data = await validate_body(request, UserCreate)
     check_access(request.user, db.models.User, "write")
     new_user = await paste_object(db.models.User, user_data, get_session_maker(request))
-    return web.json_response(new_user.dict)
+    return json_response(new_user.dict)
+
+
+@check_token
+async def create_users(request: web.Request):
+    users_data = validate_batch(await read_json(request), UserCreate)
+    check_access(request.user, db.models.User, "write")
+    results = await paste_objects(
+        db.models.User, users_data, get_session_maker(request), "email"
+    )
+    return json_response({"results": results})
 
 
 @check_token
 async def get_right(request: web.Request):
-    right_id = validate(request.match_info, ObjectId)["id"]
+    right_id = int(request.match_info["id"])
     right = await get_object_or_404(
         db.models.Right, right_id, get_session_maker(request)
     )
     check_access(request.user, right, "read")
-    return web.json_response(right.dict)
+    return json_response(right.dict)
 
 
 @check_token
 async def create_right(request: web.Request):
-    right_data = validate(await request.json(), RightCreate)
+    right_data = await validate_body(request, RightCreate)
     check_access(request.user, db.models.Right, "write")
     new_right = await paste_object(
         db.models.Right, right_data, get_session_maker(request)
     )
-    return web.json_response(new_right.dict)
+    await db.privileges.invalidate_group_everywhere(get_session_maker(request))
+    return json_response(new_right.dict)
 
 
 async def get_post(request: web.Request):
-    post_id = validate(request.match_info, ObjectId)["id"]
-    post = await get_object_or_404(db.models.Post, post_id, get_session_maker(request))
-    return web.json_response(post.dict)
+    post_id = int(request.match_info["id"])
+
+    async def load():
+        # a lagging replica could cache the pre-update row for the whole TTL
+        post = await get_object_or_404(
+            db.models.Post, post_id, get_session_maker(request), replica=False
+        )
+        return post.dict, post.version
+
+    cached = await response_cache.post_cache.get_or_load(post_id, load)
+    return cached.respond(request)
+
+
+async def list_posts(request: web.Request):
+    query = validate(request.query, PostList)
+    filters = {"owner_id": query["owner_id"]} if query["owner_id"] is not None else {}
+    posts = await db.models.Post.get_page(
+        get_session_maker(request), query["after"], query["limit"], **filters
+    )
+    next_cursor = posts[-1].id if len(posts) == query["limit"] else None
+    return json_response({"items": [post.dict for post in posts], "next": next_cursor})
+
+
+@check_token
+async def export_posts(request: web.Request):
+    check_access(request.user, db.models.Post, "read")
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    rows_stream = db.models.Post.stream_rows(
+        get_session_maker(request), config.EXPORT_BATCH_SIZE
+    )
+    chunk = bytearray()
+    try:
+        async for rows in rows_stream:
+            for row in rows:
+                chunk += dumps(db.models.Post.serialize(row))
+                chunk += b"\n"
+            if len(chunk) >= config.EXPORT_CHUNK_SIZE:
+                await response.write(bytes(chunk))
+                chunk.clear()
+    finally:
+        await rows_stream.aclose()
+    await response.write(bytes(chunk))
+    await response.write_eof()
+    return response
 
 
 @check_token
 async def create_post(request: web.Request):
-    post_data = validate(await request.json(), PostCreate)
+    post_data = await validate_body(request, PostCreate)
     post_data["owner_id"] = request.user.id
     new_post = db.models.Post(**post_data)
     check_access(request.user, new_post, "write")
     new_post = await paste_object(db.models.Post, post_data, get_session_maker(request))
-    return web.json_response(new_post.dict)
+    return json_response(new_post.dict)
+
+
+@check_token
+async def create_posts(request: web.Request):
+    posts_data = validate_batch(await read_json(request), PostCreate)
+    check_access(request.user, db.models.Post(owner_id=request.user.id), "write")
+    for post_data in posts_data:
+        if isinstance(post_data, dict):
+            post_data["owner_id"] = request.user.id
+    results = await paste_objects(
+        db.models.Post, posts_data, get_session_maker(request)
+    )
+    return json_response({"results": results})
 
 
 @check_token
 async def update_post(request: web.Request):
-    post_id = validate(request.match_info, ObjectId)["id"]
-    post_patch_data = validate(await request.json(), PostUpdate)
-    post = await db.models.Post.get_by_id(post_id, get_session_maker(request))
+    post_id = int(request.match_info["id"])
+    post_patch_data = await validate_body(request, PostUpdate)
+    post = await db.models.Post.get_by_id(
+        post_id, get_session_maker(request), replica=False
+    )
+    if post is None:
+        raise_exception(web.HTTPNotFound, {"error": "not found"})
     check_access(request.user, post, "write")
-    await post.patch(post_patch_data, get_session_maker(request))
-    return web.json_response(post.dict)
+    if_match = get_if_match(request)
+    if if_match is not None and if_match not in ("*", str(post.version)):
+        raise_exception(web.HTTPPreconditionFailed, {"error": "version mismatch"})
+    try:
+        await post.patch(post_patch_data, get_session_maker(request))
+    except Conflict:
+        raise_exception(
+            web.HTTPConflict if if_match is None else web.HTTPPreconditionFailed,
+            {"error": "post was modified concurrently"},
+        )
+    await response_cache.invalidate_post_everywhere(get_session_maker(request), post_id)
+    return json_response(post.dict, headers={"ETag": response_cache.etag(post.version)})
 
 
 async def check_health(request: web.Request):
-    return web.json_response({"status": "OK"})
+    if "deep" not in request.query:
+        return json_response({"status": "OK"})
+    try:
+        async with get_session_maker(request)() as session:
+            await asyncio.wait_for(
+                session.execute(text("SELECT 1")), config.HEALTH_DB_TIMEOUT
+            )
+    except Exception as er:
+        return json_response({"status": "error", "db": type(er).__name__}, status=503)
+    return json_response({"status": "OK", "db": "OK"})
+
+
+async def get_metrics(request: web.Request):
+    return web.Response(
+        text=metrics.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def get_stats(request: web.Request):
+    return json_response(
+        {
+            "schema_version": request.app["schema_version"],
+            "password_executor": request.app["password_executor"].stats,
+            "token_cache": token_cache.stats,
+            "token_deny_list": signed_tokens.deny_list.stats,
+            "token_sweep": auth.sweep_stats.stats,
+            "db_pool": pool_stats(get_session_maker(request)),
+            "post_response_cache": response_cache.post_cache.stats,
+            "db_coalescing": coalescing_stats(),
+            "login_password_checks": password_checks.stats,
+            "login_email_limits": login_email_buckets.stats,
+            "login_ip_limits": login_ip_buckets.stats,
+            "load_shedding": shedding.stats(),
+        }
+    )
+
+
+def register_metrics(app: web.Application):
+    metrics.register_gauges(
+        "db_pool", "Database pool state", lambda: pool_stats(app["async_session_maker"])
+    )
+    metrics.register_gauges(
+        "password_executor",
+        "Password hashing executor state",
+        lambda: app["password_executor"].stats,
+    )
+    metrics.register_gauges(
+        "token_cache", "Token cache state", lambda: token_cache.stats
+    )
+    metrics.register_gauges(
+        "token_sweep", "Expired token sweeps", lambda: auth.sweep_stats.stats
+    )
+    metrics.register_gauges(
+        "post_response_cache",
+        "GET /post/{id} response cache state",
+        lambda: response_cache.post_cache.stats,
+    )
+    metrics.register_gauges(
+        "db_coalescing", "Coalesced database reads", coalescing_stats
+    )
+    metrics.register_gauges(
+        "login_admission", "Login admission control", lambda: password_checks.stats
+    )
+    for name, queue in shedding.queues.items():
+        metrics.register_gauges(
+            f"admission_{name}",
+            f"Admission queue for {name} requests",
+            lambda queue=queue: queue.stats,
+        )
 
 
 async def get_app() -> web.Application:
-    app = web.Application()
+    check_config()
+    middlewares = [metrics.middleware, shedding.middleware]
+    if profiling.profiling_enabled():
+        middlewares.append(profiling.middleware)
+    app = web.Application(middlewares=middlewares, client_max_size=config.BODY_MAX_SIZE)
+    register_metrics(app)
     app.cleanup_ctx.append(database_context)
+    app.cleanup_ctx.append(deny_list_context)
+    app.cleanup_ctx.append(password_executor_context)
+    app.cleanup_ctx.append(notifications_context)
+    app.cleanup_ctx.append(token_sweeper_context)
     app.router.add_routes(
         [
             web.get("/health", check_health),
+            web.get("/stats", get_stats),
+            web.get("/metrics", get_metrics),
             web.post("/login", login),
+            web.post("/logout", logout),
             web.post("/user", create_user),
+            web.post("/users", create_users),
             web.get("/right/{id:\d+}", get_right),
             web.post("/right", create_right),
+            web.get("/post", list_posts),
             web.get("/post/{id:\d+}", get_post),
             web.post("/post", create_post),
+            web.post("/posts", create_posts),
+            web.get("/posts/export", export_posts),
             web.patch("/post/{id:\d+}", update_post),
         ]
     )
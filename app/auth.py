@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+
+import config
+import db.notifications
+from app import signed_tokens
+from db.cache import LoadGenerations, TTLCache
+from db.models import AccessToken, RevokedToken
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "token_cache"
+ALL_TOKENS = "*"
+
+token_cache = TTLCache(config.TOKEN_CACHE_SIZE, config.TOKEN_CACHE_TTL)
+token_loads = LoadGenerations()
+
+
+def token_lifetime_left(token: AccessToken) -> float:
+    return config.TOKEN_TTL - (time.time() - token.creation_time.timestamp())
+
+
+def check_config():
+    if config.TOKEN_MODE not in ("opaque", "signed"):
+        raise RuntimeError(f"unknown TOKEN_MODE {config.TOKEN_MODE!r}")
+    if config.TOKEN_MODE == "signed" and config.TOKEN_KEY_ID not in config.TOKEN_KEYS:
+        raise RuntimeError("TOKEN_KEY_ID must name one of TOKEN_KEYS")
+
+
+async def issue_token(user, async_session_maker) -> dict:
+    if config.TOKEN_MODE == "signed":
+        return {"token": signed_tokens.issue(user), "user_id": user.id}
+    return (await AccessToken.create(async_session_maker, user)).dict
+
+
+async def revoke_token(access_token, async_session_maker):
+    if isinstance(access_token, signed_tokens.SignedToken):
+        signed_tokens.revoke(access_token)
+        await RevokedToken.revoke(
+            access_token.signature, access_token.expires_at, async_session_maker
+        )
+        await db.notifications.notify(
+            async_session_maker,
+            signed_tokens.CHANNEL,
+            signed_tokens.notice(access_token),
+        )
+    else:
+        await access_token.delete(async_session_maker)
+        await invalidate_token_everywhere(async_session_maker, access_token.token)
+
+
+async def get_access_token(token: str, async_session_maker):
+    if not token:
+        return None
+    if signed_tokens.is_signed(token):
+        return signed_tokens.verify(token)
+    digest = AccessToken.digest(token)
+    access_token = token_cache.get(digest)
+    if access_token is None:
+        access_token, fresh = await token_loads.run(
+            digest, lambda: AccessToken.get_by_token(token, async_session_maker)
+        )
+        # skip caching a row invalidated (e.g. logged out) while it was loading
+        if access_token is not None and fresh:
+            token_cache.set(digest, access_token, token_lifetime_left(access_token))
+    return access_token
+
+
+def invalidate_digest(digest: bytes):
+    token_cache.pop(digest)
+    token_loads.invalidate(digest)
+
+
+def invalidate_token(token: str):
+    invalidate_digest(AccessToken.digest(token))
+
+
+def invalidate_user(user_id: int):
+    token_cache.remove_if(lambda access_token: access_token.user_id == user_id)
+    # the user of a token still loading is not known yet
+    token_loads.invalidate_all()
+
+
+def invalidate_all():
+    token_cache.clear()
+    token_loads.invalidate_all()
+
+
+def handle_invalidation_notice(payload: str):
+    # the listener sends "*" after a reconnect, when notices may have been missed
+    if payload == ALL_TOKENS:
+        invalidate_all()
+        return
+    kind, value = payload.split(":", 1)
+    if kind == "token":
+        invalidate_digest(bytes.fromhex(value))
+    elif kind == "user":
+        invalidate_user(int(value))
+
+
+async def invalidate_token_everywhere(async_session_maker, token: str):
+    invalidate_token(token)
+    await db.notifications.notify(
+        async_session_maker, CHANNEL, f"token:{AccessToken.digest(token).hex()}"
+    )
+
+
+async def invalidate_user_everywhere(async_session_maker, user_id: int):
+    invalidate_user(user_id)
+    await db.notifications.notify(async_session_maker, CHANNEL, f"user:{user_id}")
+
+
+async def load_deny_list(async_session_maker) -> int:
+    revoked = await RevokedToken.active(async_session_maker)
+    for signature, expires_at in revoked:
+        signed_tokens.deny_list.add(signature, expires_at, force=True)
+    return len(revoked)
+
+
+reloads = set()
+
+
+def handle_revocation_notice(async_session_maker):
+    def handle(payload: str):
+        if payload != db.notifications.RECONNECTED:
+            signed_tokens.revoke_noticed(payload)
+            return
+        # revocations may have been missed while the listener was down
+        reload = asyncio.create_task(load_deny_list(async_session_maker))
+        reloads.add(reload)
+        reload.add_done_callback(reloads.discard)
+
+    return handle
+
+
+class SweepStats:
+    def __init__(self):
+        self.sweeps = 0
+        self.failed = 0
+        self.last_reclaimed = 0
+        self.reclaimed = 0
+
+    def observe(self, reclaimed: int):
+        self.sweeps += 1
+        self.last_reclaimed = reclaimed
+        self.reclaimed += reclaimed
+
+    @property
+    def stats(self):
+        return {
+            "sweeps": self.sweeps,
+            "failed": self.failed,
+            "last_reclaimed": self.last_reclaimed,
+            "reclaimed_total": self.reclaimed,
+        }
+
+
+sweep_stats = SweepStats()
+
+
+async def sweep_expired_tokens(async_session_maker) -> int:
+    reclaimed = 0
+    for model in (AccessToken, RevokedToken):
+        while True:
+            deleted = await model.delete_expired(
+                config.TOKEN_SWEEP_BATCH, async_session_maker
+            )
+            reclaimed += deleted
+            if deleted < config.TOKEN_SWEEP_BATCH:
+                break
+            await asyncio.sleep(0)
+    signed_tokens.deny_list.purge()
+    sweep_stats.observe(reclaimed)
+    logger.info("token sweep reclaimed %s rows", reclaimed)
+    return reclaimed
+
+
+async def run_token_sweeper(async_session_maker):
+    while True:
+        await asyncio.sleep(config.TOKEN_SWEEP_INTERVAL)
+        try:
+            await sweep_expired_tokens(async_session_maker)
+        except Exception:
+            sweep_stats.failed += 1
+            logger.exception("token sweep failed")
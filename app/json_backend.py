@@ -0,0 +1,28 @@
+import json
+
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if config.JSON_BACKEND not in ("auto", "json", "orjson"):
+    raise RuntimeError(f"unknown JSON_BACKEND {config.JSON_BACKEND!r}")
+if config.JSON_BACKEND == "orjson" and orjson is None:
+    raise RuntimeError("JSON_BACKEND=orjson requires the orjson package")
+
+if orjson is not None and config.JSON_BACKEND != "json":
+
+    def dumps(data) -> bytes:
+        return orjson.dumps(data)
+
+    loads = orjson.loads
+
+else:
+
+    def dumps(data) -> bytes:
+        return json.dumps(data).encode()
+
+    loads = json.loads
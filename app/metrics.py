@@ -0,0 +1,194 @@
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from aiohttp import web
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.label_names, labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Iterable[str] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            inf_labels = _labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(
+                f"{self.name}_count{_labels(self.label_names, labels)} {count}"
+            )
+        return lines
+
+
+class Gauges:
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Dict]):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        return [
+            f'{self.name}{{key="{_escape(key)}"}} {value}'
+            for key, value in self.collect().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests handled", ("method", "route", "status")
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route")
+)
+http_exceptions = Counter(
+    "http_unhandled_exceptions_total", "Unhandled handler exceptions", ("route",)
+)
+db_queries = Counter("db_queries_total", "Database statements executed", ("type",))
+db_query_duration = Histogram(
+    "db_query_duration_seconds", "Database statement latency", ("type",)
+)
+db_errors = Counter("db_errors_total", "Database statement errors", ("type",))
+
+registry = [
+    http_requests,
+    http_request_duration,
+    http_exceptions,
+    db_queries,
+    db_query_duration,
+    db_errors,
+]
+
+
+def register_gauges(name: str, documentation: str, collect: Callable[[], Dict]):
+    registry[:] = [metric for metric in registry if metric.name != name]
+    registry.append(Gauges(name, documentation, collect))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def route_name(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def middleware(request: web.Request, handler):
+    started = time.perf_counter()
+    route = route_name(request)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as er:
+        status = er.status
+        raise
+    except Exception:
+        http_exceptions.inc(route)
+        raise
+    finally:
+        http_requests.inc(request.method, route, status)
+        http_request_duration.observe(
+            time.perf_counter() - started, request.method, route
+        )
+
+
+def statement_type(statement: str) -> str:
+    words = statement.split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    query_type = statement_type(statement)
+    db_queries.inc(query_type)
+    db_query_duration.observe(
+        time.perf_counter() - context._metrics_started, query_type
+    )
+
+
+def _handle_error(exception_context):
+    db_errors.inc(statement_type(exception_context.statement or ""))
+
+
+def instrument_engine(engine):
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "after_cursor_execute", _after_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
@@ -0,0 +1,81 @@
+import asyncio
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+
+from aiohttp import web
+from sqlalchemy import event
+
+import config
+from app.metrics import route_name
+
+PROFILE_HEADER = "X-Profile"
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("slow_query")
+
+active_profile = False
+
+
+def profiling_enabled() -> bool:
+    return config.PROFILE_SAMPLE_RATE > 0 or bool(config.PROFILE_TOKEN)
+
+
+def should_profile(request: web.Request) -> bool:
+    if (
+        config.PROFILE_TOKEN
+        and request.headers.get(PROFILE_HEADER) == config.PROFILE_TOKEN
+    ):
+        return True
+    return random.random() < config.PROFILE_SAMPLE_RATE
+
+
+def profile_path(request: web.Request) -> str:
+    route = re.sub(r"[^A-Za-z0-9]+", "_", route_name(request)).strip("_")
+    name = f"{time.time():.6f}-{request.method}-{route or 'root'}-{os.getpid()}.prof"
+    return os.path.join(config.PROFILE_DIR, name)
+
+
+@web.middleware
+async def middleware(request: web.Request, handler):
+    global active_profile
+    # cProfile hooks the whole thread, so one profile at a time
+    if active_profile or not should_profile(request):
+        return await handler(request)
+    active_profile = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return await handler(request)
+    finally:
+        profiler.disable()
+        active_profile = False
+        path = profile_path(request)
+        try:
+            os.makedirs(config.PROFILE_DIR, exist_ok=True)
+            await asyncio.get_running_loop().run_in_executor(
+                None, profiler.dump_stats, path
+            )
+        except OSError as er:
+            logger.warning("could not write profile %s: %s", path, er)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._slow_query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context._slow_query_started
+    if duration >= config.SLOW_QUERY_SECONDS:
+        slow_query_logger.warning("slow query %.3fs: %s", duration, statement)
+
+
+def instrument_slow_queries(engine):
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "after_cursor_execute", _after_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
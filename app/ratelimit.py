@@ -0,0 +1,56 @@
+import collections
+import math
+import time
+from typing import Hashable
+
+
+class TokenBuckets:
+    def __init__(self, rate: float, burst: int, max_size: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.buckets = collections.OrderedDict()
+        self.rejected = 0
+
+    @property
+    def stats(self):
+        return {"size": len(self.buckets), "rejected": self.rejected}
+
+    def take(self, key: Hashable) -> float:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        # least recently used first: those buckets have refilled the longest
+        while len(self.buckets) > self.max_size:
+            self.buckets.popitem(last=False)
+        return 0.0
+
+
+class ConcurrencyLimit:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+
+    @property
+    def stats(self):
+        return {"limit": self.limit, "active": self.active, "rejected": self.rejected}
+
+    def try_acquire(self) -> bool:
+        if self.active >= self.limit:
+            self.rejected += 1
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
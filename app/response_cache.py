@@ -0,0 +1,107 @@
+from typing import Awaitable, Callable, Hashable, Optional, Tuple
+
+from aiohttp import web
+
+import config
+import db.notifications
+from app.json_backend import dumps
+from db.cache import TTLCache
+
+CHANNEL = "response_cache"
+ALL_KEYS = "*"
+
+
+def etag(version) -> str:
+    return f'"{version}"'
+
+
+class CachedResponse:
+    def __init__(self, body: bytes, version):
+        self.body = body
+        self.etag = etag(version)
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        etags = {etag.strip().removeprefix("W/") for etag in if_none_match.split(",")}
+        return ALL_KEYS in etags or self.etag in etags
+
+    def respond(self, request: web.Request) -> web.Response:
+        if self.matches(request.headers.get("If-None-Match")):
+            return web.Response(status=304, headers={"ETag": self.etag})
+        return web.Response(
+            body=self.body,
+            content_type="application/json",
+            headers={"ETag": self.etag},
+        )
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_size: int = config.RESPONSE_CACHE_SIZE,
+        ttl: float = config.RESPONSE_CACHE_TTL,
+    ):
+        self.cache = TTLCache(max_size, ttl)
+        # key -> [generation, loads in flight]; invalidation bumps the generation
+        self.loads = {}
+
+    @property
+    def stats(self):
+        stats = self.cache.stats
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        return self.cache.get(key)
+
+    def set(self, key: Hashable, data: dict, version) -> CachedResponse:
+        cached = CachedResponse(dumps(data), version)
+        self.cache.set(key, cached)
+        return cached
+
+    async def get_or_load(
+        self, key: Hashable, load: Callable[[], Awaitable[Tuple[dict, int]]]
+    ) -> CachedResponse:
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        entry = self.loads.setdefault(key, [0, 0])
+        generation = entry[0]
+        entry[1] += 1
+        try:
+            data, version = await load()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.loads[key]
+        cached = CachedResponse(dumps(data), version)
+        if entry[0] == generation:
+            self.cache.set(key, cached)
+        return cached
+
+    def invalidate(self, key: Hashable):
+        self.cache.pop(key)
+        if key in self.loads:
+            self.loads[key][0] += 1
+
+    def clear(self):
+        self.cache.clear()
+        for entry in self.loads.values():
+            entry[0] += 1
+
+
+post_cache = ResponseCache()
+
+
+def invalidate_post(post_id: str):
+    if post_id == ALL_KEYS:
+        post_cache.clear()
+    else:
+        post_cache.invalidate(int(post_id))
+
+
+async def invalidate_post_everywhere(async_session_maker, post_id: int):
+    invalidate_post(str(post_id))
+    await db.notifications.notify(async_session_maker, CHANNEL, str(post_id))
@@ -1,23 +1,96 @@
-import json
-from typing import Any, Callable
+from typing import Any, Callable, List, Mapping, Optional, Union
 
 from aiohttp import web
-from pydantic import ValidationError
+from pydantic import ValidationError, validate_model
 
+import config
+from app.json_backend import dumps, loads
+from app.auth import get_access_token, invalidate_token
 from db.crud_ops import AlreadyExists
-from db.models import User, AccessToken
+from db.models import User
+from db.passwords import ExecutorOverloaded
+from db.privileges import load_group_mask
 from validators.models import VALIDATOR
 
 
+def json_response(data, status: int = 200, headers=None) -> web.Response:
+    return web.Response(
+        body=dumps(data),
+        status=status,
+        headers=headers,
+        content_type="application/json",
+    )
+
+
 def raise_exception(exception_class: type, body: dict):
-    raise exception_class(text=json.dumps(body), content_type="application/json")
+    raise exception_class(text=dumps(body).decode(), content_type="application/json")
+
+
+def raise_too_large(max_size: int, actual_size: int, error: str):
+    raise web.HTTPRequestEntityTooLarge(
+        max_size,
+        actual_size,
+        text=dumps({"error": error}).decode(),
+        content_type="application/json",
+    )
+
 
+def validate(data: Mapping, pydantic_model: type(VALIDATOR)) -> dict:
+    values, _, error = validate_model(pydantic_model, data)
+    if error is not None:
+        raise web.HTTPBadRequest(text=error.json(), content_type="application/json")
+    return values
 
-def validate(data: dict, pydantic_model: type(VALIDATOR)):
+
+async def read_json(request: web.Request) -> Any:
+    if request.content_length and request.content_length > config.BODY_MAX_SIZE:
+        raise_too_large(
+            config.BODY_MAX_SIZE,
+            request.content_length,
+            f"request body is larger than {config.BODY_MAX_SIZE} bytes",
+        )
     try:
-        return pydantic_model(**data).dict()
-    except ValidationError as er:
-        raise web.HTTPBadRequest(body=er.json())
+        return loads(await request.read())
+    except ValueError:
+        raise_exception(web.HTTPBadRequest, {"error": "invalid JSON body"})
+
+
+async def validate_body(request: web.Request, pydantic_model: type(VALIDATOR)) -> dict:
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        raise_exception(web.HTTPBadRequest, {"error": "JSON object expected"})
+    return validate(data, pydantic_model)
+
+
+def validate_batch(
+    data: Any, pydantic_model: type(VALIDATOR)
+) -> List[Union[dict, ValidationError]]:
+    if not isinstance(data, list):
+        raise_exception(web.HTTPBadRequest, {"error": "list of objects expected"})
+    if len(data) > config.BATCH_MAX_SIZE:
+        raise_too_large(
+            config.BATCH_MAX_SIZE,
+            len(data),
+            f"at most {config.BATCH_MAX_SIZE} objects per request",
+        )
+    return [_validate_item(item, pydantic_model) for item in data]
+
+
+def _validate_item(item: Any, pydantic_model: type(VALIDATOR)):
+    if not isinstance(item, dict):
+        try:
+            return pydantic_model.parse_obj(item).dict()
+        except ValidationError as er:
+            return er
+    values, _, error = validate_model(pydantic_model, item)
+    return values if error is None else error
+
+
+def get_if_match(request: web.Request) -> Optional[str]:
+    if_match = request.headers.get("If-Match")
+    if if_match is None:
+        return None
+    return if_match.strip().removeprefix("W/").strip('"')
 
 
 def check_access(user: User, access_model, access: str):
@@ -25,8 +98,8 @@ def check_access(user: User, access_model, access: str):
         raise_exception(web.HTTPForbidden, {"error": "privilege required"})
 
 
-async def get_object_or_404(model, object_id: int, session_maker):
-    model_object = await model.get_by_id(object_id, session_maker)
+async def get_object_or_404(model, object_id: int, session_maker, **options):
+    model_object = await model.get_by_id(object_id, session_maker, **options)
     if not model_object:
         raise raise_exception(web.HTTPNotFound, {"error": "not found"})
     return model_object
@@ -49,16 +122,51 @@ async def paste_object(model, params: dict, session_maker):
         return await model.create(session_maker, **params)
     except AlreadyExists:
         raise_exception(web.HTTPConflict, {"error": "already exists"})
+    except ExecutorOverloaded:
+        raise_exception(web.HTTPServiceUnavailable, {"error": "server is busy"})
+
+
+async def paste_objects(
+    model, objects_data: list, session_maker, conflict_field: str = None
+):
+    valid_data = [data for data in objects_data if isinstance(data, dict)]
+    try:
+        created = iter(
+            await model.create_batch(session_maker, valid_data, conflict_field)
+        )
+    except AlreadyExists:
+        raise_exception(web.HTTPConflict, {"error": "already exists"})
+    except ExecutorOverloaded:
+        raise_exception(web.HTTPServiceUnavailable, {"error": "server is busy"})
+
+    results = []
+    for data in objects_data:
+        if isinstance(data, ValidationError):
+            results.append({"status": 400, "error": loads(data.json())})
+            continue
+        new_object = next(created)
+        if new_object is None:
+            results.append({"status": 409, "error": "already exists"})
+        else:
+            results.append({"status": 200, "object": new_object.dict})
+    return results
 
 
 def check_token(handler: Callable) -> Callable:
     async def handler_with_check(request: web.Request, *args, **kwargs) -> web.Response:
-        token = request.headers.get("token")
-        token = await get_object_by_field_or_404(
-            AccessToken, "token", token, request.app["async_session_maker"]
+        token = await get_access_token(
+            request.headers.get("token"), request.app["async_session_maker"]
         )
+        if not token:
+            raise_exception(web.HTTPNotFound, {"error": "not found"})
+        if token.is_expired:
+            invalidate_token(token.token)
+            raise_exception(web.HTTPUnauthorized, {"error": "token expired"})
         request.token = token
-        request.user = User(token.user)
+        privileges = await load_group_mask(
+            token.user.group_id, request.app["async_session_maker"]
+        )
+        request.user = User(token.user, privileges=privileges)
         return await handler(request, *args, **kwargs)
 
     return handler_with_check
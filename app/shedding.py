@@ -0,0 +1,131 @@
+import asyncio
+import collections
+
+from aiohttp import web
+
+import config
+from app import ratelimit
+from app.json_backend import dumps
+from db.sessions import pool_wait
+
+EXEMPT_PATHS = {"/health", "/metrics"}
+AUTH_PATHS = {"/login", "/logout"}
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    def __init__(self, limit: int, max_queue: int, timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = collections.deque()
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+    async def acquire(self, queue: bool = True):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        if not queue or len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.timeout)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        # unlike wait_for, wait never swallows a cancellation that races the handoff
+        try:
+            done, _ = await asyncio.wait((waiter,), timeout=self.timeout)
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove(waiter)
+        if not done:
+            self.timed_out += 1
+            raise Overloaded(self.timeout)
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+queues = {
+    "auth": AdmissionQueue(
+        config.SHED_AUTH_CONCURRENCY, config.SHED_QUEUE_SIZE, config.SHED_QUEUE_TIMEOUT
+    ),
+    "reads": AdmissionQueue(
+        config.SHED_READ_CONCURRENCY, config.SHED_QUEUE_SIZE, config.SHED_QUEUE_TIMEOUT
+    ),
+    "writes": AdmissionQueue(
+        config.SHED_WRITE_CONCURRENCY,
+        config.SHED_QUEUE_SIZE,
+        config.SHED_QUEUE_TIMEOUT,
+    ),
+}
+
+
+def route_class(request: web.Request):
+    if request.path in EXEMPT_PATHS:
+        return None
+    if request.path in AUTH_PATHS:
+        return "auth"
+    if request.method in ("GET", "HEAD"):
+        return "reads"
+    return "writes"
+
+
+def stats() -> dict:
+    return {
+        "pool_wait_recent": pool_wait.recent(),
+        **{name: queue.stats for name, queue in queues.items()},
+    }
+
+
+def raise_overloaded(retry_after: float):
+    raise web.HTTPServiceUnavailable(
+        text=dumps({"error": "server overloaded"}).decode(),
+        content_type="application/json",
+        headers={"Retry-After": ratelimit.retry_after(retry_after)},
+    )
+
+
+@web.middleware
+async def middleware(request: web.Request, handler):
+    name = route_class(request)
+    if name is None:
+        return await handler(request)
+    queue = queues[name]
+    waited = pool_wait.recent()
+    # with the pool already backed up, queueing only adds to the latency
+    pool_backed_up = 0 < config.SHED_POOL_WAIT < waited
+    try:
+        await queue.acquire(queue=not pool_backed_up)
+    except Overloaded as er:
+        raise_overloaded(max(waited, er.retry_after))
+    try:
+        return await handler(request)
+    finally:
+        queue.release()
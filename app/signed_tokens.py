@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+import config
+import db.db_models
+
+CHANNEL = "revoked_tokens"
+SEPARATOR = "."
+
+
+class DenyListFull(Exception):
+    pass
+
+
+class DenyList:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = {}
+        self.refused = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, signature: str) -> bool:
+        expires_at = self.entries.get(signature)
+        return expires_at is not None and expires_at > time.time()
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "refused": self.refused,
+        }
+
+    def purge(self) -> int:
+        now = time.time()
+        expired = [key for key, expires_at in self.entries.items() if expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+        return len(expired)
+
+    def add(self, signature: str, expires_at: float, force: bool = False) -> bool:
+        # an evicted entry would make a revoked token valid again, so a full
+        # list refuses new local revocations instead of dropping old ones
+        if signature not in self.entries and len(self.entries) >= self.max_size:
+            self.purge()
+            if len(self.entries) >= self.max_size and not force:
+                self.refused += 1
+                return False
+        self.entries[signature] = expires_at
+        return True
+
+
+deny_list = DenyList(config.TOKEN_DENY_LIST_SIZE)
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(key_id: str, payload: str) -> str:
+    message = f"{key_id}{SEPARATOR}{payload}".encode()
+    key = config.TOKEN_KEYS[key_id].encode()
+    return _encode(hmac.new(key, message, hashlib.sha256).digest())
+
+
+class SignedToken:
+    def __init__(
+        self,
+        token: str,
+        key_id: str,
+        signature: str,
+        user_id: int,
+        group_id: Optional[int],
+        issued_at: int,
+    ):
+        self.token = token
+        self.key_id = key_id
+        self.signature = signature
+        self.user_id = user_id
+        self.group_id = group_id
+        self.issued_at = issued_at
+
+    @property
+    def expires_at(self) -> float:
+        return self.issued_at + config.TOKEN_TTL
+
+    @property
+    def is_expired(self):
+        return time.time() > self.expires_at
+
+    @property
+    def user(self):
+        return db.db_models.User(id=self.user_id, group_id=self.group_id)
+
+
+def is_signed(token: str) -> bool:
+    return SEPARATOR in token
+
+
+def issue(user) -> str:
+    key_id = config.TOKEN_KEY_ID
+    claims = f"{user.id}:{'' if user.group_id is None else user.group_id}"
+    payload = _encode(f"{claims}:{int(time.time())}".encode())
+    return SEPARATOR.join((key_id, payload, _sign(key_id, payload)))
+
+
+def verify(token: str) -> Optional[SignedToken]:
+    # compare_digest refuses non-ASCII strings
+    if not token.isascii():
+        return None
+    try:
+        key_id, payload, signature = token.split(SEPARATOR)
+    except ValueError:
+        return None
+    if key_id not in config.TOKEN_KEYS:
+        return None
+    if not hmac.compare_digest(signature, _sign(key_id, payload)):
+        return None
+    if signature in deny_list:
+        return None
+    user_id, group_id, issued_at = _decode(payload).decode().split(":")
+    return SignedToken(
+        token,
+        key_id,
+        signature,
+        int(user_id),
+        int(group_id) if group_id else None,
+        int(issued_at),
+    )
+
+
+def revoke(token: SignedToken):
+    if not deny_list.add(token.signature, token.expires_at):
+        raise DenyListFull
+
+
+def notice(token: SignedToken) -> str:
+    return f"{token.signature}:{token.expires_at}"
+
+
+def revoke_noticed(payload: str):
+    signature, expires_at = payload.rsplit(":", 1)
+    deny_list.add(signature, float(expires_at), force=True)
@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+from collections import defaultdict
+
+import aiohttp
+
+import config
+from db.models import Group, Post, User
+from db.sessions import get_async_session
+from tests.clean_db import hook_db
+
+PASSWORD = "Bench1234pass"
+DEFAULT_MIX = "login=1,get_post=6,create_post=2,patch_post=1"
+
+
+async def seed(users: int, posts: int):
+    await hook_db()
+    async with get_async_session(config.DB) as async_session_maker:
+        group = (await Group.get_by_field("name", "user", async_session_maker))[0]
+        created_users = await User.create_batch(
+            async_session_maker,
+            [
+                {
+                    "email": f"bench{index}@bench.com",
+                    "password": PASSWORD,
+                    "group_id": group.id,
+                }
+                for index in range(users)
+            ],
+        )
+        for start in range(0, posts, config.BATCH_MAX_SIZE):
+            await Post.create_batch(
+                async_session_maker,
+                [
+                    {
+                        "title": f"title {index}",
+                        "text": f"text {index}",
+                        "owner_id": random.choice(created_users).id,
+                    }
+                    for index in range(start, min(posts, start + config.BATCH_MAX_SIZE))
+                ],
+            )
+
+
+def percentile(latencies, fraction: float) -> float:
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+class Workload:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        users: int,
+        honor_retry_after: bool = True,
+    ):
+        self.session = session
+        self.url = url
+        self.users = users
+        self.honor_retry_after = honor_retry_after
+        self.accounts = []
+        self.post_ids = []
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def request(self, route: str, method: str, path: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            async with self.session.request(
+                method, f"{self.url}{path}", **kwargs
+            ) as response:
+                body = await response.read()
+                status = response.status
+                retry_after = response.headers.get("Retry-After")
+        except aiohttp.ClientError as er:
+            body, status, retry_after = b"", type(er).__name__, None
+        self.latencies[route].append(time.perf_counter() - started)
+        self.statuses[route][str(status)] += 1
+        if retry_after and self.honor_retry_after:
+            await asyncio.sleep(float(retry_after))
+        return status, body
+
+    def random_email(self) -> str:
+        return f"bench{random.randrange(self.users)}@bench.com"
+
+    async def login(self, email: str = None):
+        status, body = await self.request(
+            "login",
+            "POST",
+            "/login",
+            json={"email": email or self.random_email(), "password": PASSWORD},
+        )
+        return json.loads(body)["token"] if status == 200 else None
+
+    async def prepare(self, accounts: int, posts: int):
+        for index in range(min(accounts, self.users)):
+            token = await self.login(f"bench{index}@bench.com")
+            if token:
+                self.accounts.append({"token": token, "post_ids": []})
+        page = {"next": None}
+        while len(self.post_ids) < posts:
+            params = {"limit": config.PAGE_SIZE_MAX}
+            if page["next"]:
+                params["after"] = page["next"]
+            async with self.session.get(f"{self.url}/post", params=params) as response:
+                page = await response.json()
+            self.post_ids += [post["id"] for post in page["items"]]
+            if page["next"] is None:
+                break
+        self.latencies.clear()
+        self.statuses.clear()
+
+    async def get_post(self):
+        if self.post_ids:
+            await self.request(
+                "get_post", "GET", f"/post/{random.choice(self.post_ids)}"
+            )
+
+    async def create_post(self):
+        account = random.choice(self.accounts)
+        status, body = await self.request(
+            "create_post",
+            "POST",
+            "/post",
+            json={"title": "bench", "text": "bench"},
+            headers={"token": account["token"]},
+        )
+        if status == 200:
+            account["post_ids"].append(json.loads(body)["id"])
+
+    async def patch_post(self):
+        account = random.choice(self.accounts)
+        if not account["post_ids"]:
+            return await self.create_post()
+        await self.request(
+            "patch_post",
+            "PATCH",
+            f"/post/{random.choice(account['post_ids'])}",
+            json={"text": f"bench {random.random()}"},
+            headers={"token": account["token"]},
+        )
+
+    def report(self, elapsed: float) -> dict:
+        routes = {}
+        for route, latencies in self.latencies.items():
+            latencies.sort()
+            routes[route] = {
+                "requests": len(latencies),
+                "rps": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "statuses": dict(self.statuses[route]),
+            }
+        total = sum(route["requests"] for route in routes.values())
+        return {
+            "elapsed_s": elapsed,
+            "requests": total,
+            "rps": total / elapsed,
+            "routes": routes,
+        }
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def run(args) -> dict:
+    if args.seed_db:
+        await seed(args.users, args.posts)
+    weights = parse_mix(args.mix)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        workload = Workload(session, args.url, args.users, not args.ignore_retry_after)
+        await workload.prepare(args.concurrency, args.posts)
+        if not workload.accounts:
+            raise SystemExit(
+                "could not log in any benchmark user, seed the server's database "
+                "with --seed-db"
+            )
+        operations = [getattr(workload, name) for name in weights]
+        deadline = time.perf_counter() + args.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                operation = random.choices(operations, list(weights.values()))[0]
+                await operation()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        report = workload.report(time.perf_counter() - started)
+    report["parameters"] = {
+        "url": args.url,
+        "users": args.users,
+        "posts": args.posts,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "mix": weights,
+        "honor_retry_after": not args.ignore_retry_after,
+    }
+    report["commit"] = git_commit()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mixed-workload HTTP load test")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument(
+        "--seed-db",
+        action="store_true",
+        help="drop and re-create config.DB with benchmark data before the run; "
+        "it must be the database behind --url and everything in it is lost",
+    )
+    parser.add_argument(
+        "--ignore-retry-after",
+        action="store_true",
+        help="retry 429/503 responses immediately instead of backing off",
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import json
+import timeit
+
+from sqlalchemy.future import select
+
+from db.crud_ops import select_by_field
+from db.models import AccessToken, Post, User
+
+LOOKUPS = {
+    "token": (AccessToken, "token_digest", b"\0" * 32),
+    "email": (User, "email", "admin@admin.com"),
+    "id": (Post, "id", 1),
+}
+
+
+def build_per_call(orm_class, field, value, options):
+    statement = select(orm_class).where(getattr(orm_class, field) == value)
+    return statement.options(*options)._generate_cache_key()
+
+
+def build_cached(orm_class, field, value, options):
+    return select_by_field(orm_class, field, options)._generate_cache_key()
+
+
+def measure(function, model, field, value, number: int) -> float:
+    options = model.loading_options()
+    seconds = timeit.timeit(
+        lambda: function(model.orm_class, field, value, options), number=number
+    )
+    return seconds / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-call statement construction overhead in microseconds"
+    )
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, (model, field, value) in LOOKUPS.items():
+        before = measure(build_per_call, model, field, value, args.number)
+        after = measure(build_cached, model, field, value, args.number)
+        results[name] = {
+            "per_call_us": round(before, 2),
+            "cached_us": round(after, 2),
+            "speedup": round(before / after, 1),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def get(self, key: Hashable, default: Any = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def remove_if(self, predicate: Callable[[Any], bool]) -> int:
+        keys = [key for key, (_, value) in self.entries.items() if predicate(value)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class LoadGenerations:
+    def __init__(self):
+        # key -> [generation, loads in flight]; invalidation bumps the generation
+        self.loads = {}
+
+    async def run(self, key: Hashable, load: Callable[[], Awaitable[Any]]):
+        entry = self.loads.setdefault(key, [0, 0])
+        generation = entry[0]
+        entry[1] += 1
+        try:
+            value = await load()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.loads[key]
+        return value, entry[0] == generation
+
+    def invalidate(self, key: Hashable):
+        if key in self.loads:
+            self.loads[key][0] += 1
+
+    def invalidate_all(self):
+        for entry in self.loads.values():
+            entry[0] += 1
@@ -1,37 +1,372 @@
 import abc
+import asyncio
 from contextlib import asynccontextmanager
 
 import sqlalchemy
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.future import select
-from typing import Iterable, Any
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import Any, Callable, Hashable, Iterable, List, Optional
 from sqlalchemy.exc import IntegrityError
 
-
-import db.models
+import config
+from db.serializers import compile_serializer
+from db.sessions import get_read_session_maker, pool_wait
 
 
 class AlreadyExists(Exception):
     pass
 
 
+class Conflict(Exception):
+    pass
+
+
+async def _acquire_connection(session):
+    with pool_wait.waiting():
+        await session.connection()
+
+
+statement_cache = {}
+
+
+def cached_statement(key: Hashable, build: Callable):
+    statement = statement_cache.get(key)
+    if statement is None:
+        statement = statement_cache[key] = build()
+    return statement
+
+
+def select_by_field(orm_class, field: str, options=()):
+    return cached_statement(
+        ("select_by_field", orm_class, field, options),
+        lambda: select(orm_class)
+        .where(getattr(orm_class, field) == bindparam("value"))
+        .options(*options),
+    )
+
+
+def select_by_ids(orm_class, options=()):
+    return cached_statement(
+        ("select_by_ids", orm_class, options),
+        lambda: select(orm_class)
+        .where(orm_class.id.in_(bindparam("ids", expanding=True)))
+        .options(*options),
+    )
+
+
+def select_page(orm_class, filter_fields: tuple, after: bool, options=()):
+    def build():
+        query = select(orm_class).where(
+            *(getattr(orm_class, field) == bindparam(field) for field in filter_fields)
+        )
+        if after:
+            query = query.where(orm_class.id > bindparam("after"))
+        return query.order_by(orm_class.id).limit(bindparam("limit")).options(*options)
+
+    return cached_statement(
+        ("select_page", orm_class, filter_fields, after, options), build
+    )
+
+
+def update_by_id(
+    orm_class,
+    fields: tuple,
+    version_field: str,
+    check_version: bool,
+    returning: bool = True,
+):
+    def build():
+        table = orm_class.__table__
+        statement = sqlalchemy.update(table).where(table.c.id == bindparam("_id"))
+        values = {field: bindparam(field) for field in fields}
+        if version_field:
+            version = table.c[version_field]
+            values[version_field] = version + 1
+            if check_version:
+                statement = statement.where(version == bindparam("_version"))
+        statement = statement.values(values)
+        return statement.returning(*table.c) if returning else statement
+
+    return cached_statement(
+        ("update_by_id", orm_class, fields, version_field, check_version, returning),
+        build,
+    )
+
+
+def select_row_by_id(orm_class):
+    table = orm_class.__table__
+    return cached_statement(
+        ("select_row_by_id", orm_class),
+        lambda: select(table).where(table.c.id == bindparam("_id")),
+    )
+
+
+def detached_from_row(orm_class, row):
+    orm_object = orm_class(**row)
+    make_transient_to_detached(orm_object)
+    return orm_object
+
+
+def detached_copy(orm_object):
+    # coalesced reads hand one loaded object to many callers, each gets its own
+    if orm_object is None:
+        return None
+    state = inspect(orm_object)
+    mapper = state.mapper
+    orm_copy = mapper.class_(
+        **{
+            attr.key: state.dict[attr.key]
+            for attr in mapper.column_attrs
+            if attr.key in state.dict
+        }
+    )
+    make_transient_to_detached(orm_copy)
+    for relationship in mapper.relationships:
+        if relationship.key not in state.dict:
+            continue
+        value = state.dict[relationship.key]
+        if relationship.uselist:
+            value = [detached_copy(item) for item in value]
+        else:
+            value = detached_copy(value)
+        set_committed_value(orm_copy, relationship.key, value)
+    return orm_copy
+
+
 @asynccontextmanager
 async def get_session(async_session_maker):
     async with async_session_maker() as session:
         async with session.begin():
+            await _acquire_connection(session)
             yield session
 
 
-async def get_by_id(orm_class, object_id: int, async_session_maker):
-    async with get_session(async_session_maker) as session:
-        return await session.get(orm_class, object_id)
-
-
-async def get_by_field(orm_class, field: str, value: Any, async_session_maker):
-    query = select(orm_class).where(getattr(orm_class, field) == value)
-
-    async with get_session(async_session_maker) as session:
-        result = await session.execute(query)
-        return list(result.unique().scalars())
+@asynccontextmanager
+async def get_read_session(async_session_maker, readonly=None, replica=None):
+    readonly = config.DB_READONLY_READS if readonly is None else readonly
+    replica = config.DB_READ_FROM_REPLICA if replica is None else replica
+    read_session_maker = get_read_session_maker(async_session_maker, readonly, replica)
+    if not readonly:
+        async with get_session(read_session_maker) as session:
+            yield session
+        return
+    async with read_session_maker() as session:
+        await _acquire_connection(session)
+        yield session
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        self.calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: Hashable, load: Callable):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+
+class IdBatcher:
+    def __init__(self):
+        self.pending = {}
+        self.running = set()
+        self.queries = 0
+        self.requested = 0
+
+    async def load(self, key: Hashable, object_id: int, load_many: Callable):
+        loop = asyncio.get_running_loop()
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = {}
+            loop.call_soon(self._flush, key, load_many)
+        future = loop.create_future()
+        batch.setdefault(object_id, []).append(future)
+        self.requested += 1
+        return await future
+
+    def _flush(self, key: Hashable, load_many: Callable):
+        batch = self.pending.pop(key)
+        self.queries += 1
+        # the loop only keeps weak references to tasks
+        task = asyncio.ensure_future(self._run(batch, load_many))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    @staticmethod
+    async def _run(batch: dict, load_many: Callable):
+        try:
+            objects = {
+                orm_object.id: orm_object for orm_object in await load_many(list(batch))
+            }
+        except Exception as er:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(er)
+            return
+        for object_id, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(objects.get(object_id))
+
+
+single_flight = SingleFlight()
+id_batcher = IdBatcher()
+
+
+def coalescing_stats() -> dict:
+    return {
+        "coalesced": single_flight.coalesced,
+        "batched_id_lookups": id_batcher.requested,
+        "id_batch_queries": id_batcher.queries,
+        "queries_saved": single_flight.coalesced
+        + id_batcher.requested
+        - id_batcher.queries,
+    }
+
+
+async def _get_by_ids(
+    orm_class, object_ids: List[int], async_session_maker, readonly, replica, options
+):
+    statement = select_by_ids(orm_class, options)
+
+    async with get_read_session(async_session_maker, readonly, replica) as session:
+        result = await session.execute(statement, {"ids": object_ids})
+        return list(result.scalars())
+
+
+async def _get_by_id(
+    orm_class, object_id: int, async_session_maker, readonly, replica, options
+):
+    statement = select_by_field(orm_class, "id", options)
+
+    async with get_read_session(async_session_maker, readonly, replica) as session:
+        result = await session.execute(statement, {"value": object_id})
+        return result.scalar_one_or_none()
+
+
+async def _get_by_field(
+    orm_class, field: str, value: Any, async_session_maker, readonly, replica, options
+):
+    statement = select_by_field(orm_class, field, options)
+
+    async with get_read_session(async_session_maker, readonly, replica) as session:
+        result = await session.execute(statement, {"value": value})
+        return list(result.scalars())
+
+
+async def get_by_id(
+    orm_class,
+    object_id: int,
+    async_session_maker,
+    readonly=None,
+    replica=None,
+    options=(),
+    coalesce=None,
+):
+    coalesce = config.DB_COALESCE_READS if coalesce is None else coalesce
+    if not coalesce:
+        return await _get_by_id(
+            orm_class, object_id, async_session_maker, readonly, replica, options
+        )
+    batch_key = (orm_class, async_session_maker, readonly, replica, options)
+    orm_object = await single_flight.do(
+        ("id", object_id, *batch_key),
+        lambda: id_batcher.load(
+            batch_key,
+            object_id,
+            lambda object_ids: _get_by_ids(
+                orm_class,
+                object_ids,
+                async_session_maker,
+                readonly,
+                replica,
+                options,
+            ),
+        ),
+    )
+    return detached_copy(orm_object)
+
+
+async def get_by_field(
+    orm_class,
+    field: str,
+    value: Any,
+    async_session_maker,
+    readonly=None,
+    replica=None,
+    options=(),
+    coalesce=None,
+):
+    coalesce = config.DB_COALESCE_READS if coalesce is None else coalesce
+
+    async def load():
+        return await _get_by_field(
+            orm_class, field, value, async_session_maker, readonly, replica, options
+        )
+
+    if not coalesce:
+        return await load()
+    key = (
+        "field",
+        orm_class,
+        field,
+        value,
+        async_session_maker,
+        readonly,
+        replica,
+        options,
+    )
+    return [
+        detached_copy(orm_object) for orm_object in await single_flight.do(key, load)
+    ]
+
+
+async def get_page(
+    orm_class,
+    after: Optional[int],
+    limit: int,
+    filters: dict,
+    async_session_maker,
+    readonly=None,
+    replica=None,
+    options=(),
+):
+    statement = select_page(orm_class, tuple(filters), after is not None, options)
+    params = {**filters, "after": after, "limit": limit}
+
+    async with get_read_session(async_session_maker, readonly, replica) as session:
+        result = await session.execute(statement, params)
+        return list(result.scalars())
+
+
+async def stream_rows(orm_class, batch_size: int, async_session_maker, replica=None):
+    table = orm_class.__table__
+    query = select(table).order_by(table.c.id)
+
+    # asyncpg only opens server-side cursors inside a transaction
+    async with get_read_session(
+        async_session_maker, readonly=False, replica=replica
+    ) as session:
+        result = await session.stream(query)
+        async for rows in result.mappings().partitions(batch_size):
+            yield rows
 
 
 async def insert(orm_object, async_session_maker):
@@ -53,26 +388,159 @@ async def insert_many(orm_objects: Iterable, async_session_maker):
         return orm_objects
 
 
-async def update(orm_object, patch: dict, async_session_maker):
+async def insert_rows(
+    orm_class, rows: List[dict], async_session_maker, conflict_field: str = None
+) -> List[Optional[Any]]:
+    if not rows:
+        return []
+    table = orm_class.__table__
 
     async with get_session(async_session_maker) as session:
-        for key, value in patch.items():
-            setattr(orm_object, key, value)
-        statement = sqlalchemy.update(orm_object.orm_class).values(**patch)
-        statement.execution_options(synchronize_session="fetch")
+        dialect = session.bind.dialect
+        try:
+            if dialect.full_returning:
+                if not conflict_field:
+                    # RETURNING order is unspecified, match the rows by their ids
+                    ids = await _allocate_ids(session, table, len(rows))
+                    rows = [{**row, "id": id_} for row, id_ in zip(rows, ids)]
+                statement = postgresql.insert(table).values(rows).returning(*table.c)
+                if conflict_field:
+                    statement = statement.on_conflict_do_nothing(
+                        index_elements=[conflict_field]
+                    )
+                inserted = (await session.execute(statement)).mappings().all()
+            else:
+                inserted = await _insert_rows_one_by_one(
+                    session, orm_class, rows, conflict_field
+                )
+        except IntegrityError:
+            raise AlreadyExists
+
+    if not conflict_field and not dialect.full_returning:
+        # inserted one by one, in order
+        return [detached_from_row(orm_class, row) for row in inserted]
+    key_field = conflict_field or "id"
+    inserted = {row[key_field]: row for row in inserted}
+    return [
+        detached_from_row(orm_class, inserted.pop(row[key_field]))
+        if row[key_field] in inserted
+        else None
+        for row in rows
+    ]
+
+
+async def _allocate_ids(session, table, count: int) -> List[int]:
+    statement = cached_statement(
+        "allocate_ids",
+        lambda: sqlalchemy.text(
+            "SELECT nextval(pg_get_serial_sequence(:table, 'id'))"
+            " FROM generate_series(1, :count)"
+        ),
+    )
+    table_name = session.bind.dialect.identifier_preparer.format_table(table)
+    result = await session.execute(statement, {"table": table_name, "count": count})
+    return list(result.scalars())
+
+
+async def _insert_rows_one_by_one(session, orm_class, rows, conflict_field):
+    table = orm_class.__table__
+    statement = sqlite.insert(table)
+    if conflict_field:
+        statement = statement.on_conflict_do_nothing(index_elements=[conflict_field])
+    ids = []
+    for row in rows:
+        result = await session.execute(statement, row)
+        if result.rowcount:
+            ids.append(result.inserted_primary_key[0])
+    if not ids:
+        return []
+    query = select(table).where(table.c.id.in_(ids)).order_by(table.c.id)
+    return (await session.execute(query)).mappings().all()
+
+
+async def update(
+    orm_class,
+    object_id: int,
+    patch: dict,
+    async_session_maker,
+    version_field: str = None,
+    expected_version: int = None,
+):
+    params = {**patch, "_id": object_id, "_version": expected_version}
+
+    async with get_session(async_session_maker) as session:
+        returning = session.bind.dialect.full_returning
+        statement = update_by_id(
+            orm_class,
+            tuple(sorted(patch)),
+            version_field,
+            expected_version is not None,
+            returning,
+        )
+        result = await session.execute(statement, params)
+        if returning:
+            row = result.mappings().first()
+        elif result.rowcount:
+            row = (
+                (await session.execute(select_row_by_id(orm_class), params))
+                .mappings()
+                .first()
+            )
+        else:
+            row = None
+    if row is None:
+        raise Conflict
+    return detached_from_row(orm_class, row)
+
+
+async def delete(orm_class, object_id: int, async_session_maker):
+    async with get_session(async_session_maker) as session:
+        statement = sqlalchemy.delete(orm_class).where(orm_class.id == object_id)
         await session.execute(statement)
         await session.commit()
-    return orm_object
+
+
+async def delete_batch(orm_class, condition, batch_size: int, async_session_maker):
+    batch = select(orm_class.id).where(condition).limit(batch_size)
+    async with get_session(async_session_maker) as session:
+        statement = (
+            sqlalchemy.delete(orm_class)
+            .where(orm_class.id.in_(batch.scalar_subquery()))
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(statement)
+        await session.commit()
+    return result.rowcount
 
 
 class BaseCrudModel(abc.ABC):
     orm_class = None
     access_alias = None
     exclude_fields = set()
+    extra_fields = set()
+    version_field = None
+    serializer = None
+    loading_profiles = {"columns": ()}
+    default_profile = "columns"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.orm_class is not None:
+            cls.serializer = staticmethod(
+                compile_serializer(cls.orm_class, cls.exclude_fields, cls.extra_fields)
+            )
 
     def __init__(self, orm_object=None, **kwargs):
         self.orm_object = orm_object or self.orm_class(**kwargs)
 
+    @classmethod
+    def serialize(cls, values) -> dict:
+        return cls.serializer(values)
+
+    @classmethod
+    def loading_options(cls, profile: str = None):
+        return cls.loading_profiles[profile or cls.default_profile]
+
     @classmethod
     async def create(cls, async_session_maker, **kwargs):
         return cls(await insert(cls.orm_class(**kwargs), async_session_maker))
@@ -83,22 +551,105 @@ class BaseCrudModel(abc.ABC):
         return await insert_many(orm_objects, async_session_maker)
 
     @classmethod
-    async def get_by_id(cls, object_id: int, async_session_maker):
-        orm_object = await get_by_id(cls.orm_class, object_id, async_session_maker)
+    async def create_batch(
+        cls, async_session_maker, objects_data: List[dict], conflict_field: str = None
+    ):
+        return [
+            cls(orm_object) if orm_object is not None else None
+            for orm_object in await insert_rows(
+                cls.orm_class, objects_data, async_session_maker, conflict_field
+            )
+        ]
+
+    @classmethod
+    async def get_by_id(
+        cls,
+        object_id: int,
+        async_session_maker,
+        readonly=None,
+        replica=None,
+        profile: str = None,
+    ):
+        orm_object = await get_by_id(
+            cls.orm_class,
+            object_id,
+            async_session_maker,
+            readonly,
+            replica,
+            cls.loading_options(profile),
+        )
         if orm_object:
             return cls(orm_object)
 
     @classmethod
-    async def get_by_field(cls, field: str, value: Any, async_session_maker):
+    async def get_by_field(
+        cls,
+        field: str,
+        value: Any,
+        async_session_maker,
+        readonly=None,
+        replica=None,
+        profile: str = None,
+    ):
         return [
             cls(obj)
             for obj in await get_by_field(
-                cls.orm_class, field, value, async_session_maker
+                cls.orm_class,
+                field,
+                value,
+                async_session_maker,
+                readonly,
+                replica,
+                cls.loading_options(profile),
             )
         ]
 
-    async def patch(self, patch_data: dict, async_session_maker):
-        return await update(self, patch_data, async_session_maker)
+    @classmethod
+    async def get_page(
+        cls,
+        async_session_maker,
+        after: Optional[int] = None,
+        limit: int = config.PAGE_SIZE,
+        readonly=None,
+        replica=None,
+        profile: str = None,
+        **filters,
+    ):
+        return [
+            cls(obj)
+            for obj in await get_page(
+                cls.orm_class,
+                after,
+                limit,
+                filters,
+                async_session_maker,
+                readonly,
+                replica,
+                cls.loading_options(profile),
+            )
+        ]
+
+    @classmethod
+    def stream_rows(cls, async_session_maker, batch_size: int, replica=None):
+        return stream_rows(cls.orm_class, batch_size, async_session_maker, replica)
+
+    async def patch(
+        self, patch_data: dict, async_session_maker, expected_version: int = None
+    ):
+        if self.version_field and expected_version is None:
+            expected_version = getattr(self, self.version_field)
+        self.orm_object = await update(
+            self.orm_class,
+            self.id,
+            patch_data,
+            async_session_maker,
+            self.version_field,
+            expected_version,
+        )
+        return self
+
+    async def delete(self, async_session_maker):
+        return await delete(self.orm_class, self.id, async_session_maker)
 
     def __getattr__(self, attr: str):
         return getattr(self.orm_object, attr)
@@ -111,10 +662,4 @@ class BaseCrudModel(abc.ABC):
 
     @property
     def dict(self):
-        return {
-            key: value
-            for key, value in self.orm_object.__dict__.items()
-            if not callable(value)
-            and not key.startswith("_")
-            and key not in self.exclude_fields
-        }
+        return self.serializer(self.orm_object.__dict__)
@@ -1,4 +1,5 @@
 import enum
+from datetime import timezone
 
 from sqlalchemy import (
     Table,
@@ -6,17 +7,35 @@ from sqlalchemy import (
     Column,
     String,
     Integer,
+    LargeBinary,
     Enum,
     ForeignKey,
     func,
+    Index,
     UniqueConstraint,
 )
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import declarative_base, relationship
 
 
 Base = declarative_base()
 
 
+class UTCDateTime(TypeDecorator):
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None and dialect.name == "sqlite":
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
 class AccessObject(str, enum.Enum):
     user: str = "user"
     group: str = "group"
@@ -34,6 +53,13 @@ class AccessScope(str, enum.Enum):
     all: str = "all"
 
 
+schema_version = Table(
+    "schema_version",
+    Base.metadata,
+    Column("version", Integer, nullable=False),
+)
+
+
 group_rights = Table(
     "group_rights",
     Base.metadata,
@@ -68,7 +94,7 @@ class Group(Base):
         Integer, primary_key=True, autoincrement=True, unique=True, nullable=False
     )
     name = Column(String(256), nullable=False, unique=True)
-    rights = relationship("Right", secondary=group_rights, lazy="joined")
+    rights = relationship("Right", secondary=group_rights, lazy="raise")
 
 
 class User(Base):
@@ -81,7 +107,7 @@ class User(Base):
     email = Column(String(256), unique=True, index=True)
     password = Column(String(128), nullable=False)
     group_id = Column(Integer, ForeignKey("group.id"), nullable=True)
-    group = relationship("Group", lazy="joined")
+    group = relationship("Group", lazy="raise")
 
 
 class AccessToken(Base):
@@ -91,20 +117,33 @@ class AccessToken(Base):
     id = Column(
         Integer, primary_key=True, autoincrement=True, unique=True, nullable=False
     )
-    token = Column(String, unique=True, index=True)
+    token_digest = Column(LargeBinary(32), unique=True, index=True, nullable=False)
     user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
-    user = relationship("User", lazy="joined")
-    creation_time = Column(DateTime(timezone=True), server_default=func.now())
+    user = relationship("User", lazy="raise")
+    creation_time = Column(UTCDateTime, server_default=func.now(), index=True)
+
+
+class RevokedToken(Base):
+
+    __tablename__ = "revoked_token"
+
+    id = Column(
+        Integer, primary_key=True, autoincrement=True, unique=True, nullable=False
+    )
+    signature = Column(String(64), unique=True, nullable=False)
+    expires_at = Column(UTCDateTime, nullable=False, index=True)
 
 
 class Post(Base):
 
     __tablename__ = "post"
+    __table_args__ = (Index("ix_post_owner_id_id", "owner_id", "id"),)
 
     id = Column(
         Integer, primary_key=True, autoincrement=True, unique=True, nullable=False
     )
     owner_id = Column(Integer, ForeignKey("user.id"), nullable=True)
-    owner = relationship("User", lazy="joined")
+    owner = relationship("User", lazy="raise")
     title = Column(String(128), nullable=False)
     text = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
@@ -0,0 +1,123 @@
+import asyncio
+
+from sqlalchemy import func, inspect, select, text
+
+import config
+from db.db_models import Base, RevokedToken, schema_version
+from db.sessions import get_async_session
+
+
+def _column_names(connection, table: str):
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+async def index_token_creation_time(connection):
+    await connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_access_token_creation_time "
+            "ON access_token (creation_time)"
+        )
+    )
+
+
+async def store_token_digests(connection):
+    columns = await connection.run_sync(_column_names, "access_token")
+    if "token" not in columns:
+        return
+    for statement in (
+        "ALTER TABLE access_token ADD COLUMN IF NOT EXISTS token_digest bytea",
+        "UPDATE access_token SET token_digest = sha256(convert_to(token, 'UTF8')) "
+        "WHERE token_digest IS NULL",
+        "ALTER TABLE access_token ALTER COLUMN token_digest SET NOT NULL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_access_token_token_digest "
+        "ON access_token (token_digest)",
+        "ALTER TABLE access_token DROP COLUMN token",
+    ):
+        await connection.execute(text(statement))
+
+
+async def add_post_version(connection):
+    columns = await connection.run_sync(_column_names, "post")
+    if "version" in columns:
+        return
+    await connection.execute(
+        text("ALTER TABLE post ADD COLUMN version integer NOT NULL DEFAULT 1")
+    )
+
+
+async def index_post_owner(connection):
+    await connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_post_owner_id_id ON post (owner_id, id)")
+    )
+
+
+async def create_revoked_tokens(connection):
+    await connection.run_sync(RevokedToken.__table__.create, checkfirst=True)
+
+
+MIGRATIONS = [
+    index_token_creation_time,
+    store_token_digests,
+    add_post_version,
+    index_post_owner,
+    create_revoked_tokens,
+]
+
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class SchemaMismatch(RuntimeError):
+    pass
+
+
+def _has_schema_version(connection):
+    return inspect(connection).has_table(schema_version.name)
+
+
+async def get_schema_version(connection):
+    if not await connection.run_sync(_has_schema_version):
+        return None
+    return (
+        await connection.execute(select(func.max(schema_version.c.version)))
+    ).scalar()
+
+
+async def apply_migrations(async_session_maker) -> int:
+    async with async_session_maker() as session:
+        async with session.begin():
+            connection = await session.connection()
+            if connection.dialect.name == "postgresql":
+                await connection.execute(
+                    text("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+                )
+            current = await get_schema_version(connection)
+            await connection.run_sync(Base.metadata.create_all)
+            for migration in MIGRATIONS[current or 0 :]:
+                await migration(connection)
+            if current != SCHEMA_VERSION:
+                await connection.execute(schema_version.delete())
+                await connection.execute(
+                    schema_version.insert().values(version=SCHEMA_VERSION)
+                )
+    return SCHEMA_VERSION
+
+
+async def check_schema_version(async_session_maker) -> int:
+    async with async_session_maker() as session:
+        current = await get_schema_version(await session.connection())
+    if current != SCHEMA_VERSION:
+        raise SchemaMismatch(
+            f"database schema is at version {current}, expected {SCHEMA_VERSION}; "
+            "run python -m db.migrations"
+        )
+    return current
+
+
+async def migrate(dsn: str = config.DB, drop: bool = False) -> int:
+    async with get_async_session(dsn, drop=drop) as async_session_maker:
+        return await apply_migrations(async_session_maker)
+
+
+if __name__ == "__main__":
+    print(f"schema version {asyncio.run(migrate())}")
@@ -1,11 +1,16 @@
+import hashlib
 import secrets
 import time
+from datetime import datetime, timedelta, timezone
 
-import bcrypt
+from sqlalchemy.future import select
+from sqlalchemy.orm import joinedload, selectinload
 
 import config
 import db.db_models
-from db.crud_ops import BaseCrudModel
+import db.passwords
+import db.privileges
+from db.crud_ops import BaseCrudModel, delete_batch, get_read_session, insert_rows
 
 
 class Right(BaseCrudModel):
@@ -16,28 +21,63 @@ class Right(BaseCrudModel):
 class Group(BaseCrudModel):
     access_alias = db.db_models.AccessObject("group")
     orm_class = db.db_models.Group
+    loading_profiles = {
+        "columns": (),
+        "with_rights": (selectinload(db.db_models.Group.rights),),
+    }
 
 
 class User(BaseCrudModel):
     access_alias = db.db_models.AccessObject("user")
     orm_class = db.db_models.User
     exclude_fields = {"password"}
+    loading_profiles = {
+        "columns": (),
+        "with_group": (joinedload(db.db_models.User.group),),
+        "with_privileges": (
+            joinedload(db.db_models.User.group).selectinload(db.db_models.Group.rights),
+        ),
+    }
+
+    def __init__(self, orm_object=None, privileges: int = None, **kwargs):
+        super().__init__(orm_object, **kwargs)
+        object.__setattr__(self, "_privileges", privileges)
 
     @classmethod
     async def create(cls, async_session_maker, **kwargs):
-        kwargs["password"] = bcrypt.hashpw(
-            kwargs["password"].encode(), bcrypt.gensalt()
-        ).decode()
+        kwargs["password"] = await db.passwords.hash_password(kwargs["password"])
         return await super().create(async_session_maker, **kwargs)
 
-    def check_password(self, password: str):
-        return bcrypt.checkpw(password.encode(), self.password.encode())
+    @classmethod
+    async def create_batch(
+        cls, async_session_maker, objects_data, conflict_field: str = "email"
+    ):
+        passwords = await db.passwords.hash_passwords(
+            [object_data["password"] for object_data in objects_data]
+        )
+        objects_data = [
+            {**object_data, "password": password}
+            for object_data, password in zip(objects_data, passwords)
+        ]
+        return await super().create_batch(
+            async_session_maker, objects_data, conflict_field
+        )
+
+    async def check_password(self, password: str):
+        return await db.passwords.check_password(password, self.password)
+
+    async def rehash_password(self, password: str, async_session_maker) -> bool:
+        if not db.passwords.needs_rehash(self.password):
+            return False
+        hashed = await db.passwords.hash_password(password)
+        await self.patch({"password": hashed}, async_session_maker)
+        return True
 
     @property
     def privileges(self):
-        return set(
-            (right.object, right.access, right.scope) for right in self.group.rights
-        )
+        if self._privileges is not None:
+            return self._privileges
+        return db.privileges.get_group_mask(self.group_id)
 
     def is_owner(self, crud_object):
 
@@ -50,23 +90,29 @@ class User(BaseCrudModel):
         return False
 
     def has_access(self, crud_object, access: str):
-        possible_scopes = (
-            (db.db_models.AccessScope("self"), db.db_models.AccessScope("all"))
-            if self.is_owner(crud_object)
-            else (db.db_models.AccessScope("all"),)
+        return db.privileges.has_access(
+            self.privileges,
+            crud_object.access_alias,
+            access,
+            self.is_owner(crud_object),
         )
-        privileges = self.privileges
-        access = db.db_models.AccessRight(access)
-        for scope in possible_scopes:
-            if (crud_object.access_alias, access, scope) in privileges:
-                return True
 
 
 class AccessToken(BaseCrudModel):
     access_alias = "access_token"
     orm_class = db.db_models.AccessToken
 
-    exclude_fields = {"user"}
+    exclude_fields = {"user", "token_digest"}
+    extra_fields = {"token"}
+    loading_profiles = {
+        "columns": (),
+        "with_user": (joinedload(db.db_models.AccessToken.user),),
+    }
+    default_profile = "with_user"
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
 
     @property
     def is_expired(self):
@@ -74,13 +120,75 @@ class AccessToken(BaseCrudModel):
 
     @classmethod
     async def get_by_token(cls, token: str, async_session_maker):
-        tokens = await cls.get_by_field("token", token, async_session_maker)
-        return tokens[0] if tokens else None
+        if token is None:
+            return None
+        tokens = await cls.get_by_field(
+            "token_digest", cls.digest(token), async_session_maker, replica=False
+        )
+        if not tokens:
+            return None
+        tokens[0].token = token
+        return tokens[0]
 
     @classmethod
     async def create(cls, async_session_maker, user: User):
         token = secrets.token_urlsafe(config.TOKEN_LENGTH)
-        return await super().create(async_session_maker, user=user, token=token)
+        access_token = await super().create(
+            async_session_maker, user_id=user.id, token_digest=cls.digest(token)
+        )
+        access_token.token = token
+        return access_token
+
+    @classmethod
+    async def delete_expired(cls, batch_size: int, async_session_maker):
+        expired_before = datetime.now(timezone.utc) - timedelta(
+            seconds=config.TOKEN_TTL
+        )
+        return await delete_batch(
+            cls.orm_class,
+            cls.orm_class.creation_time < expired_before,
+            batch_size,
+            async_session_maker,
+        )
+
+
+class RevokedToken(BaseCrudModel):
+    access_alias = "revoked_token"
+    orm_class = db.db_models.RevokedToken
+
+    @classmethod
+    async def revoke(cls, signature: str, expires_at: float, async_session_maker):
+        await insert_rows(
+            cls.orm_class,
+            [
+                {
+                    "signature": signature,
+                    "expires_at": datetime.fromtimestamp(expires_at, timezone.utc),
+                }
+            ],
+            async_session_maker,
+            conflict_field="signature",
+        )
+
+    @classmethod
+    async def active(cls, async_session_maker):
+        query = select(cls.orm_class.signature, cls.orm_class.expires_at).where(
+            cls.orm_class.expires_at > datetime.now(timezone.utc)
+        )
+        async with get_read_session(async_session_maker, replica=False) as session:
+            rows = await session.execute(query)
+            return [
+                (signature, expires_at.timestamp()) for signature, expires_at in rows
+            ]
+
+    @classmethod
+    async def delete_expired(cls, batch_size: int, async_session_maker):
+        return await delete_batch(
+            cls.orm_class,
+            cls.orm_class.expires_at < datetime.now(timezone.utc),
+            batch_size,
+            async_session_maker,
+        )
 
 
 class Post(BaseCrudModel):
@@ -88,3 +196,8 @@ class Post(BaseCrudModel):
     orm_class = db.db_models.Post
 
     exclude_fields = {"owner"}
+    version_field = "version"
+    loading_profiles = {
+        "columns": (),
+        "with_owner": (joinedload(db.db_models.Post.owner),),
+    }
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from typing import Callable, Dict
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+import config
+import db.crud_ops
+
+logger = logging.getLogger(__name__)
+
+RECONNECTED = "*"
+
+
+def is_postgres(dsn: str) -> bool:
+    return make_url(dsn).get_backend_name() == "postgresql"
+
+
+async def notify(async_session_maker, channel: str, payload: str = ""):
+    async with db.crud_ops.get_session(async_session_maker) as session:
+        if session.bind.dialect.name != "postgresql":
+            return
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": channel, "payload": payload},
+        )
+
+
+async def listen(dsn: str, handlers: Dict[str, Callable[[str], None]]):
+    url = make_url(dsn).set(drivername="postgresql")
+    connected_before = False
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(url.render_as_string(False))
+            closed = asyncio.get_running_loop().create_future()
+            connection.add_termination_listener(
+                lambda _: closed.done() or closed.set_result(None)
+            )
+            for channel, handler in handlers.items():
+                await connection.add_listener(
+                    channel,
+                    lambda _conn, _pid, _channel, payload, handler=handler: handler(
+                        payload
+                    ),
+                )
+                if connected_before:
+                    handler(RECONNECTED)
+            connected_before = True
+            await closed
+            logger.warning("notification connection lost, reconnecting")
+        except Exception:
+            logger.exception("notification listener failed, reconnecting")
+        finally:
+            if connection is not None and not connection.is_closed():
+                connection.terminate()
+        await asyncio.sleep(config.NOTIFY_RECONNECT_DELAY)
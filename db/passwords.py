@@ -0,0 +1,109 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List
+
+import bcrypt
+
+import config
+
+
+class ExecutorOverloaded(Exception):
+    pass
+
+
+def _hash_password(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordExecutor:
+    executor_classes = {"process": ProcessPoolExecutor, "thread": ThreadPoolExecutor}
+
+    def __init__(
+        self,
+        kind: str = config.PASSWORD_EXECUTOR,
+        workers: int = config.PASSWORD_WORKERS,
+        max_queue: int = config.PASSWORD_QUEUE,
+    ):
+        self.executor = self.executor_classes[kind](max_workers=workers)
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.slots = asyncio.Semaphore(workers)
+        self.in_flight = 0
+        self.queued = 0
+
+    @property
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+        }
+
+    async def run(self, func, *args):
+        if self.queued >= self.max_queue:
+            raise ExecutorOverloaded
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_executor = None
+
+
+def get_executor() -> PasswordExecutor:
+    global _executor
+    if _executor is None:
+        _executor = PasswordExecutor()
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+async def hash_password(password: str) -> str:
+    hashed = await get_executor().run(
+        _hash_password, password.encode(), config.BCRYPT_ROUNDS
+    )
+    return hashed.decode()
+
+
+async def check_password(password: str, hashed: str) -> bool:
+    return await get_executor().run(_check_password, password.encode(), hashed.encode())
+
+
+def needs_rehash(hashed: str) -> bool:
+    return int(hashed.split("$")[2]) != config.BCRYPT_ROUNDS
+
+
+async def hash_passwords(passwords: List[str]) -> List[str]:
+    step = get_executor().workers
+    hashed = []
+    for start in range(0, len(passwords), step):
+        hashed += await asyncio.gather(
+            *(hash_password(password) for password in passwords[start : start + step])
+        )
+    return hashed
@@ -0,0 +1,88 @@
+import itertools
+
+from sqlalchemy.future import select
+
+import db.crud_ops
+import db.notifications
+from db.cache import LoadGenerations
+from db.db_models import AccessObject, AccessRight, AccessScope, Right, group_rights
+
+CHANNEL = "group_privileges"
+ALL_GROUPS = "*"
+
+RIGHT_BITS = {
+    (object_.value, access.value, scope.value): 1 << bit
+    for bit, (object_, access, scope) in enumerate(
+        itertools.product(AccessObject, AccessRight, AccessScope)
+    )
+}
+
+REQUIRED_MASKS = {
+    (object_.value, access.value, is_owner): sum(
+        RIGHT_BITS[(object_.value, access.value, scope)]
+        for scope in (("self", "all") if is_owner else ("all",))
+    )
+    for object_, access, is_owner in itertools.product(
+        AccessObject, AccessRight, (False, True)
+    )
+}
+
+group_masks = {}
+mask_loads = LoadGenerations()
+
+
+def compile_rights(rights) -> int:
+    mask = 0
+    for object_, access, scope in rights:
+        mask |= RIGHT_BITS[(object_.value, access.value, scope.value)]
+    return mask
+
+
+def get_group_mask(group_id: int) -> int:
+    return group_masks.get(group_id, 0)
+
+
+def has_access(mask: int, access_alias, access: str, is_owner: bool) -> bool:
+    return bool(mask & REQUIRED_MASKS.get((access_alias, access, is_owner), 0))
+
+
+async def query_group_mask(group_id: int, async_session_maker) -> int:
+    query = (
+        select(Right.object, Right.access, Right.scope)
+        .join(group_rights, group_rights.c.right_id == Right.id)
+        .where(group_rights.c.group_id == group_id)
+    )
+    # masks are kept until invalidated, never fill them from a lagging replica
+    async with db.crud_ops.get_read_session(
+        async_session_maker, replica=False
+    ) as session:
+        return compile_rights(await session.execute(query))
+
+
+async def load_group_mask(group_id: int, async_session_maker) -> int:
+    if group_id is None:
+        return 0
+    mask = group_masks.get(group_id)
+    if mask is not None:
+        return mask
+    mask, fresh = await mask_loads.run(
+        group_id, lambda: query_group_mask(group_id, async_session_maker)
+    )
+    # a group changed while its mask was loading may have lost a right
+    if fresh:
+        group_masks[group_id] = mask
+    return mask
+
+
+def invalidate_group(group_id=ALL_GROUPS):
+    if group_id == ALL_GROUPS:
+        group_masks.clear()
+        mask_loads.invalidate_all()
+    else:
+        group_masks.pop(int(group_id), None)
+        mask_loads.invalidate(int(group_id))
+
+
+async def invalidate_group_everywhere(async_session_maker, group_id=ALL_GROUPS):
+    invalidate_group(group_id)
+    await db.notifications.notify(async_session_maker, CHANNEL, str(group_id))
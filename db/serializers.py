@@ -0,0 +1,49 @@
+import enum
+from typing import Callable, Iterable, Mapping
+
+from sqlalchemy import DateTime, Enum
+
+
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+def _enum_value(value):
+    return value.value if isinstance(value, enum.Enum) else value
+
+
+def _converter(column):
+    column_type = getattr(column.type, "impl", column.type)
+    if isinstance(column_type, DateTime):
+        return _isoformat
+    if isinstance(column_type, Enum):
+        return _enum_value
+    return None
+
+
+def compile_serializer(
+    orm_class, exclude_fields: Iterable[str] = (), extra_fields: Iterable[str] = ()
+) -> Callable[[Mapping], dict]:
+    exclude_fields = set(exclude_fields)
+    columns = [
+        column
+        for column in orm_class.__table__.columns
+        if column.key not in exclude_fields
+    ]
+    plain_fields = tuple(
+        column.key for column in columns if _converter(column) is None
+    ) + tuple(extra_fields)
+    converted_fields = tuple(
+        (column.key, _converter(column))
+        for column in columns
+        if _converter(column) is not None
+    )
+
+    def serialize(values: Mapping) -> dict:
+        data = {key: values[key] for key in plain_fields if key in values}
+        for key, convert in converted_fields:
+            if key in values:
+                data[key] = convert(values[key])
+        return data
+
+    return serialize
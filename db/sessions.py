@@ -1,25 +1,195 @@
-from contextlib import asynccontextmanager
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager, contextmanager
 from typing import ContextManager
 
+import config
 from db.db_models import Base
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
 
+class PoolWaitStats:
+    def __init__(self, decay: float = 1.0):
+        self.count = 0
+        self.failed = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.decay = decay
+        self.recent_value = 0.0
+        self.updated = time.monotonic()
+        # acquisitions in progress, oldest first
+        self.pending = {}
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        recent = self.recent_completed()
+        self.recent_value = recent + (seconds - recent) * 0.2
+        self.updated = time.monotonic()
+
+    @contextmanager
+    def waiting(self):
+        key = object()
+        started = self.pending[key] = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            del self.pending[key]
+            self.observe(time.monotonic() - started)
+
+    def oldest(self) -> float:
+        for started in self.pending.values():
+            return time.monotonic() - started
+        return 0.0
+
+    def recent_completed(self) -> float:
+        return self.recent_value * math.exp(
+            (self.updated - time.monotonic()) / self.decay
+        )
+
+    def recent(self) -> float:
+        # a stalled pool completes no waits, so count the ones still blocked
+        return max(self.recent_completed(), self.oldest())
+
+    @property
+    def stats(self):
+        return {
+            "waits": self.count,
+            "waits_failed": self.failed,
+            "waiting": len(self.pending),
+            "wait_seconds_total": self.total,
+            "wait_seconds_max": self.max,
+            "wait_seconds_oldest": self.oldest(),
+            "wait_seconds_recent": self.recent(),
+        }
+
+
+pool_wait = PoolWaitStats()
+
+
+def is_memory_sqlite(dsn: str) -> bool:
+    url = make_url(dsn)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_options(dsn: str) -> dict:
+    backend = make_url(dsn).get_backend_name()
+    if backend == "sqlite":
+        return {"connect_args": {"timeout": config.DB_POOL_TIMEOUT}}
+    if backend != "postgresql":
+        return {}
+    return {
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+        "pool_recycle": config.DB_POOL_RECYCLE,
+        "pool_pre_ping": config.DB_POOL_PRE_PING,
+        # asyncpg prepares every statement under a generated name, even with
+        # the caches off, so PgBouncer works in session pooling mode only
+        "connect_args": {
+            "statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+        },
+    }
+
+
+def pool_stats(async_session_maker) -> dict:
+    pool = async_session_maker.kw["bind"].sync_engine.pool
+    stats = dict(pool_wait.stats)
+    if hasattr(pool, "checkedout"):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    return stats
+
+
+async def _open_connection(engine):
+    connection = await engine.connect()
+    await connection.exec_driver_sql("SELECT 1")
+    return connection
+
+
+async def warm_pool(engine, connections: int) -> int:
+    pool = engine.sync_engine.pool
+    if not hasattr(pool, "size"):
+        return 0
+    opened = await asyncio.gather(
+        *(_open_connection(engine) for _ in range(min(connections, pool.size()))),
+        return_exceptions=True,
+    )
+    for connection in opened:
+        if not isinstance(connection, BaseException):
+            await connection.close()
+    for connection in opened:
+        if isinstance(connection, BaseException):
+            raise connection
+    return len(opened)
+
+
+def _enable_foreign_keys(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def create_engine(dsn: str):
+    engine = create_async_engine(dsn, **engine_options(dsn))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", _enable_foreign_keys)
+    return engine
+
+
+def make_session_maker(engine):
+    return sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+def get_read_session_maker(async_session_maker, readonly: bool, replica: bool):
+    readers = getattr(async_session_maker, "readers", {})
+    return readers.get((readonly, replica), async_session_maker)
+
+
 @asynccontextmanager
 async def get_async_session(
-    dsn: str, drop: bool = False, create: bool = False
+    dsn: str, drop: bool = False, create: bool = False, replica_dsn: str = None
 ) -> ContextManager[AsyncSession]:
-    engine = create_async_engine(dsn)
+    engine = create_engine(dsn)
     async with engine.begin() as conn:
         if drop:
             await conn.run_sync(Base.metadata.drop_all)
         if create:
             await conn.run_sync(Base.metadata.create_all)
-    async_session_maker = sessionmaker(
-        engine, expire_on_commit=False, class_=AsyncSession
-    )
+    replica_engine = create_engine(replica_dsn) if replica_dsn else engine
+    async_session_maker = make_session_maker(engine)
+    async_session_maker.engines = list({engine, replica_engine})
+    if is_memory_sqlite(dsn):
+        # a single shared connection: switching it to autocommit would commit
+        # whatever another session has in flight on it
+        async_session_maker.readers = {}
+    else:
+        async_session_maker.readers = {
+            (False, False): async_session_maker,
+            (True, False): make_session_maker(
+                engine.execution_options(isolation_level="AUTOCOMMIT")
+            ),
+            (False, True): make_session_maker(replica_engine),
+            (True, True): make_session_maker(
+                replica_engine.execution_options(isolation_level="AUTOCOMMIT")
+            ),
+        }
 
     yield async_session_maker
 
     await engine.dispose()
+    if replica_engine is not engine:
+        await replica_engine.dispose()
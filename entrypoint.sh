@@ -15,4 +15,6 @@ while [ "$1" != "" ]; do
     shift
 done
 
+python -m db.migrations || exit 1
+
 gunicorn app.app:get_app --bind "${host}:${port}" --worker-class aiohttp.GunicornWebWorker
@@ -1,4 +1,5 @@
 from config import DB
+from db.migrations import migrate
 from db.sessions import get_async_session
 from db.models import Group, Right, User
 import asyncio
@@ -23,7 +24,8 @@ user_rights_data = [
 
 
 async def hook_db():
-    async with get_async_session(DB, True, True) as async_session_maker:
+    await migrate(DB, drop=True)
+    async with get_async_session(DB) as async_session_maker:
 
         admin_rights = await Right.create_many(async_session_maker, admin_rights_data)
         user_rights = await Right.create_many(async_session_maker, user_rights_data)
@@ -1,17 +1,59 @@
+import asyncio
+import os
+import tempfile
+import threading
+
 import pytest
 
 
 def pytest_addoption(parser):
-    parser.addoption("--url", action="store", default="http://127.0.0.1:8080")
+    parser.addoption(
+        "--url",
+        action="store",
+        default=None,
+        help="test a running server; by default an in-process one is started on DB",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption("--url") is None:
+        database = os.path.join(tempfile.mkdtemp(), "test.db")
+        os.environ.setdefault("DB", f"sqlite+aiosqlite:///{database}")
+        os.environ.setdefault("BCRYPT_ROUNDS", "4")
+        # every test logs in through the autouse fixtures
+        os.environ.setdefault("LOGIN_BURST_PER_EMAIL", "10000")
+        os.environ.setdefault("LOGIN_BURST_PER_IP", "10000")
+
 
+@pytest.fixture(scope="session")
+def url(request):
+    option_value = request.config.getoption("--url")
+    if option_value is not None:
+        yield option_value
+        return
+
+    from aiohttp.test_utils import TestServer
 
-def pytest_generate_tests(metafunc):
+    from app.app import get_app
 
-    option_value = metafunc.config.option.url
-    if "url" in metafunc.fixturenames and option_value is not None:
-        metafunc.parametrize("url", [option_value])
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    app = asyncio.run_coroutine_threadsafe(get_app(), loop).result()
+    server = TestServer(app)
+    asyncio.run_coroutine_threadsafe(server.start_server(), loop).result()
+    yield str(server.make_url("")).rstrip("/")
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
 
 
 @pytest.fixture(scope="session")
 def get_url(request):
     return request.config.getoption("--url")
+
+
+@pytest.fixture()
+def in_process(get_url):
+    if get_url is not None:
+        pytest.skip("patches the server, needs the in-process one")
@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from app import auth
+from db.models import AccessToken
+
+
+def cache_token(token: str, user_id: int):
+    auth.token_cache.set(AccessToken.digest(token), SimpleNamespace(user_id=user_id))
+
+
+def test_invalidation_notices():
+    auth.invalidate_all()
+    cache_token("first", 1)
+    cache_token("second", 1)
+    cache_token("third", 2)
+
+    auth.handle_invalidation_notice(f"token:{AccessToken.digest('third').hex()}")
+    assert auth.token_cache.get(AccessToken.digest("third")) is None
+    assert auth.token_cache.get(AccessToken.digest("first")) is not None
+
+    auth.handle_invalidation_notice("user:1")
+    assert len(auth.token_cache) == 0
+
+    cache_token("first", 1)
+    auth.handle_invalidation_notice(auth.ALL_TOKENS)
+    assert len(auth.token_cache) == 0
+
+
+def test_token_invalidated_while_loading_is_not_cached(monkeypatch):
+    async def scenario(invalidate):
+        auth.invalidate_all()
+        loaded = asyncio.Event()
+
+        async def get_by_token(token, async_session_maker):
+            await loaded.wait()
+            return SimpleNamespace(user_id=1, creation_time=datetime.now(timezone.utc))
+
+        monkeypatch.setattr(AccessToken, "get_by_token", get_by_token)
+        lookup = asyncio.ensure_future(auth.get_access_token("token", None))
+        await asyncio.sleep(0)
+        invalidate()
+        loaded.set()
+        assert await lookup is not None
+        return auth.token_cache.get(AccessToken.digest("token"))
+
+    assert asyncio.run(scenario(lambda: None)) is not None
+    assert asyncio.run(scenario(lambda: auth.invalidate_token("token"))) is None
+    assert asyncio.run(scenario(lambda: auth.invalidate_user(1))) is None
+    assert not auth.token_loads.loads
@@ -0,0 +1,72 @@
+import asyncio
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from db import crud_ops
+from db.db_models import Group, Right, User
+
+
+def loaded_user():
+    group = crud_ops.detached_from_row(Group, {"id": 1, "name": "admins"})
+    right = crud_ops.detached_from_row(
+        Right, {"id": 1, "object": "post", "access": "read", "scope": "all"}
+    )
+    set_committed_value(group, "rights", [right])
+    user = crud_ops.detached_from_row(
+        User, {"id": 7, "email": "a@b.c", "password": "x", "group_id": 1}
+    )
+    set_committed_value(user, "group", group)
+    return user
+
+
+def test_coalesced_callers_get_their_own_objects(monkeypatch):
+    loads = []
+
+    async def get_by_ids(orm_class, object_ids, *args):
+        loads.append(object_ids)
+        await asyncio.sleep(0)
+        return [loaded_user()]
+
+    monkeypatch.setattr(crud_ops, "_get_by_ids", get_by_ids)
+
+    async def main():
+        return await asyncio.gather(
+            *(crud_ops.get_by_id(User, 7, None, coalesce=True) for _ in range(2))
+        )
+
+    first, second = asyncio.run(main())
+    assert loads == [[7]]
+    assert first is not second
+    assert first.group is not second.group
+    assert first.group.rights[0] is not second.group.rights[0]
+
+    first.email = "changed@b.c"
+    first.group.rights.clear()
+    assert second.email == "a@b.c"
+    assert second.group.name == "admins"
+    assert len(second.group.rights) == 1
+
+
+def test_id_batcher_keeps_its_queries_alive():
+    async def scenario():
+        batcher = crud_ops.IdBatcher()
+        loaded = asyncio.Event()
+
+        async def load_many(object_ids):
+            await loaded.wait()
+            return [crud_ops.detached_from_row(Group, {"id": 1, "name": "a"})]
+
+        lookups = [
+            asyncio.ensure_future(batcher.load("groups", object_id, load_many))
+            for object_id in (1, 2)
+        ]
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert len(batcher.running) == 1
+        loaded.set()
+        first, missing = await asyncio.gather(*lookups)
+        assert first.name == "a" and missing is None
+        assert batcher.queries == 1
+        assert not batcher.running
+
+    asyncio.run(scenario())
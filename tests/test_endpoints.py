@@ -1,4 +1,5 @@
 import asyncio
+import json
 
 import pytest
 import requests
@@ -71,6 +72,21 @@ class TestEndpoits:
         )
         assert response.status_code == 200
 
+    def test_create_user_in_missing_group(self, url, su_token):
+        user_data = {"password": "FGSDgse334ffdr2", "group_id": 999}
+        response = auth_request(
+            url, su_token, "post", "user", {**user_data, "email": "nogroup@user.com"}
+        )
+        assert response.status_code == 409
+        response = auth_request(
+            url,
+            su_token,
+            "post",
+            "users",
+            [{**user_data, "email": "nogroup2@user.com"}],
+        )
+        assert response.status_code == 409
+
     def test_create_existed_user(self, url, su_token):
         response = auth_request(
             url,
@@ -150,3 +166,375 @@ class TestEndpoits:
             url, new_user_token, "patch", "post/1", {"title": "new_title_2"}
         )
         assert response.status_code == 403
+
+    def test_logout(self, url):
+        token = request_user_token(url).json()["token"]
+        response = auth_request(url, token, "post", "logout", None)
+        assert response.status_code == 200
+        response = auth_request(url, token, "post", "logout", None)
+        assert response.status_code == 404
+
+    def test_update_post_version_mismatch(self, url, user_token):
+        version = auth_request(url, user_token, "get", "post/1", None).json()["version"]
+        response = requests.patch(
+            f"{url}/post/1",
+            json={"text": "new_text"},
+            headers={"token": user_token, "If-Match": f'"{version + 1}"'},
+        )
+        assert response.status_code == 412
+        response = requests.patch(
+            f"{url}/post/1",
+            json={"text": "new_text"},
+            headers={"token": user_token, "If-Match": f'"{version}"'},
+        )
+        assert response.status_code == 200
+        assert response.json()["version"] == version + 1
+
+    def test_create_users(self, url, su_token):
+        response = auth_request(
+            url,
+            su_token,
+            "post",
+            "users",
+            [
+                {
+                    "email": "batch@user.com",
+                    "password": "FGSDgse334ffdr2",
+                    "group_id": 2,
+                },
+                {"email": "new@user.com", "password": "FGSDgse334ffdr2", "group_id": 2},
+                {"email": "weak@user.com", "password": "1234", "group_id": 2},
+            ],
+        )
+        assert response.status_code == 200
+        statuses = [result["status"] for result in response.json()["results"]]
+        assert statuses == [200, 409, 400]
+
+    def test_create_users_without_privilege(self, url, user_token):
+        response = auth_request(url, user_token, "post", "users", [])
+        assert response.status_code == 403
+
+    def test_create_posts(self, url, user_token):
+        response = auth_request(
+            url,
+            user_token,
+            "post",
+            "posts",
+            [{"title": "first", "text": "some_text"}, {"title": "second"}],
+        )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["status"] for result in results] == [200, 400]
+        assert results[0]["object"]["title"] == "first"
+
+        titles = [f"title {index}" for index in range(20)]
+        response = auth_request(
+            url,
+            user_token,
+            "post",
+            "posts",
+            [{"title": title, "text": title} for title in titles],
+        )
+        objects = [result["object"] for result in response.json()["results"]]
+        assert [post["title"] for post in objects] == titles
+        assert [post["text"] for post in objects] == titles
+
+        created = results[0]["object"]
+        response = requests.get(f"{url}/post/{created['id']}")
+        assert response.status_code == 200
+        assert response.json() == created
+
+    def test_create_posts_batch_too_large(self, url, user_token):
+        response = auth_request(
+            url, user_token, "post", "posts", [{"title": "t", "text": "t"}] * 1001
+        )
+        assert response.status_code == 413
+        assert response.json()["error"]
+
+    def test_list_posts(self, url, user_token):
+        auth_request(
+            url,
+            user_token,
+            "post",
+            "posts",
+            [{"title": "a", "text": "a"}, {"title": "b", "text": "b"}],
+        )
+        first_page = requests.get(f"{url}/post", params={"limit": 2}).json()
+        assert len(first_page["items"]) == 2
+        second_page = requests.get(
+            f"{url}/post", params={"limit": 2, "after": first_page["next"]}
+        ).json()
+        assert second_page["items"][0]["id"] > first_page["items"][-1]["id"]
+
+    def test_list_posts_by_owner(self, url):
+        response = requests.get(f"{url}/post", params={"owner_id": 1})
+        assert response.status_code == 200
+        assert response.json() == {"items": [], "next": None}
+
+    def test_list_posts_limit_too_big(self, url):
+        response = requests.get(f"{url}/post", params={"limit": 100000})
+        assert response.status_code == 400
+
+    def test_export_posts(self, url, user_token):
+        response = auth_request(url, user_token, "get", "posts/export", None)
+        assert response.status_code == 200
+        posts = [json.loads(line) for line in response.text.splitlines()]
+        assert posts
+        assert [post["id"] for post in posts] == sorted(post["id"] for post in posts)
+
+    def test_get_post_not_modified(self, url):
+        response = requests.get(f"{url}/post/1")
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        response = requests.get(f"{url}/post/1", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+    def test_get_post_etag_changes_on_update(self, url, user_token):
+        etag = requests.get(f"{url}/post/1").headers["ETag"]
+        auth_request(url, user_token, "patch", "post/1", {"text": "changed_text"})
+        response = requests.get(f"{url}/post/1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["text"] == "changed_text"
+
+    def test_update_post_with_get_etag(self, url, user_token):
+        etag = requests.get(f"{url}/post/1").headers["ETag"]
+        response = requests.Session().patch(
+            f"{url}/post/1",
+            json={"text": "etag_text"},
+            headers={"token": user_token, "If-Match": etag},
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert requests.get(f"{url}/post/1").headers["ETag"] == response.headers["ETag"]
+
+        response = requests.Session().patch(
+            f"{url}/post/1",
+            json={"text": "stale_text"},
+            headers={"token": user_token, "If-Match": etag},
+        )
+        assert response.status_code == 412
+
+    def test_deep_health(self, url):
+        response = requests.get(f"{url}/health", params={"deep": "1"})
+        assert response.status_code == 200
+        assert response.json()["db"] == "OK"
+
+    def test_metrics(self, url):
+        requests.get(f"{url}/post/1")
+        response = requests.get(f"{url}/metrics")
+        assert response.status_code == 200
+        assert 'http_requests_total{method="GET",route="/post/{id}"' in response.text
+        assert "db_queries_total" in response.text
+
+    def test_create_post_invalid_json(self, url, user_token):
+        response = requests.post(
+            f"{url}/post", data=b'{"title": ', headers={"token": user_token}
+        )
+        assert response.status_code == 400
+
+    def test_create_post_body_too_large(self, url, user_token):
+        response = requests.post(
+            f"{url}/post",
+            data=b" " * (1024 * 1024 + 1),
+            headers={"token": user_token},
+        )
+        assert response.status_code == 413
+
+    def test_update_missing_post(self, url, user_token):
+        response = auth_request(url, user_token, "patch", "post/999999", {"text": "x"})
+        assert response.status_code == 404
+
+    def test_login_rate_limited(self, url, in_process, monkeypatch):
+        import app.app
+        from app.ratelimit import TokenBuckets
+
+        monkeypatch.setattr(app.app, "login_email_buckets", TokenBuckets(0.01, 1, 10))
+        assert request_user_token(url).status_code == 200
+        response = request_user_token(url)
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        assert request_superuser_token(url).status_code == 200
+
+    def test_login_rehashes_on_cost_change(
+        self, url, su_token, in_process, monkeypatch
+    ):
+        import config
+        from db.models import User
+        from db.sessions import get_async_session
+
+        async def stored_hash():
+            async with get_async_session(config.DB) as async_session_maker:
+                users = await User.get_by_field(
+                    "email", "rehash@user.com", async_session_maker
+                )
+                return users[0].password
+
+        credentials = {"email": "rehash@user.com", "password": "Rehash1234"}
+        response = auth_request(
+            url, su_token, "post", "user", {**credentials, "group_id": 2}
+        )
+        assert response.status_code == 200
+        rounds = config.BCRYPT_ROUNDS
+        assert asyncio.run(stored_hash()).split("$")[2] == f"{rounds:02}"
+
+        monkeypatch.setattr(config, "BCRYPT_ROUNDS", rounds + 1)
+        assert requests.post(f"{url}/login", json=credentials).status_code == 200
+        assert asyncio.run(stored_hash()).split("$")[2] == f"{rounds + 1:02}"
+        assert requests.post(f"{url}/login", json=credentials).status_code == 200
+
+    def test_signed_token_logout_survives_restart(self, url, in_process, monkeypatch):
+        import config
+        from app import auth, signed_tokens
+        from db.sessions import get_async_session
+
+        monkeypatch.setattr(config, "TOKEN_MODE", "signed")
+        monkeypatch.setattr(config, "TOKEN_KEYS", {"k1": "secret"})
+        monkeypatch.setattr(config, "TOKEN_KEY_ID", "k1")
+        token = request_user_token(url).json()["token"]
+        assert signed_tokens.is_signed(token)
+        response = auth_request(url, token, "post", "post", {"title": "t", "text": "t"})
+        assert response.status_code == 200
+
+        assert auth_request(url, token, "post", "logout", None).status_code == 200
+        response = auth_request(url, token, "post", "post", {"title": "t", "text": "t"})
+        assert response.status_code == 404
+
+        async def reload_deny_list():
+            async with get_async_session(config.DB) as async_session_maker:
+                return await auth.load_deny_list(async_session_maker)
+
+        signed_tokens.deny_list.entries.clear()
+        assert asyncio.run(reload_deny_list()) >= 1
+        response = auth_request(url, token, "post", "post", {"title": "t", "text": "t"})
+        assert response.status_code == 404
+
+    def test_expired_token_is_rejected_and_evicted(self, url, in_process, monkeypatch):
+        import config
+        from app import auth
+        from db.models import AccessToken
+
+        token = request_user_token(url).json()["token"]
+        response = auth_request(url, token, "post", "post", {"title": "t", "text": "t"})
+        assert response.status_code == 200
+        assert auth.token_cache.get(AccessToken.digest(token)) is not None
+
+        monkeypatch.setattr(config, "TOKEN_TTL", -1)
+        response = auth_request(url, token, "post", "post", {"title": "t", "text": "t"})
+        assert response.status_code == 401
+        assert auth.token_cache.get(AccessToken.digest(token)) is None
+
+    def test_sweep_deletes_expired_tokens_in_batches(
+        self, url, in_process, monkeypatch
+    ):
+        import config
+        import db.models
+        from app import auth
+        from db.sessions import get_async_session
+
+        tokens = [request_user_token(url).json()["token"] for _ in range(5)]
+        deleted = []
+        crud_delete_batch = db.models.delete_batch
+
+        async def delete_batch(orm_class, *args):
+            count = await crud_delete_batch(orm_class, *args)
+            deleted.append((orm_class.__name__, count))
+            return count
+
+        async def sweep():
+            async with get_async_session(config.DB) as async_session_maker:
+                return await auth.sweep_expired_tokens(async_session_maker)
+
+        monkeypatch.setattr(db.models, "delete_batch", delete_batch)
+        monkeypatch.setattr(config, "TOKEN_SWEEP_BATCH", 2)
+        assert asyncio.run(sweep()) == 0
+
+        monkeypatch.setattr(config, "TOKEN_TTL", -1)
+        deleted.clear()
+        reclaimed = asyncio.run(sweep())
+        assert reclaimed >= len(tokens)
+        counts = [count for name, count in deleted if name == "AccessToken"]
+        assert sum(counts) == reclaimed
+        assert len(counts) > 1
+        assert all(count == 2 for count in counts[:-1])
+        assert counts[-1] < 2
+
+        swept = requests.get(f"{url}/stats").json()["token_sweep"]
+        assert swept["last_reclaimed"] == reclaimed
+        assert swept["reclaimed_total"] >= reclaimed
+        metrics = requests.get(f"{url}/metrics").text
+        assert f'token_sweep{{key="last_reclaimed"}} {reclaimed}' in metrics
+
+        monkeypatch.undo()
+        for token in tokens:
+            auth.invalidate_token(token)
+            response = auth_request(url, token, "post", "post", {"title": "t"})
+            assert response.status_code == 404
+
+    def test_post_cache_is_filled_from_the_primary(
+        self, url, user_token, in_process, monkeypatch
+    ):
+        import config
+        from app import response_cache
+        from db import crud_ops
+
+        post_id = auth_request(
+            url, user_token, "post", "post", {"title": "t", "text": "t"}
+        ).json()["id"]
+        routed = []
+
+        def get_read_session_maker(async_session_maker, readonly, replica):
+            routed.append(replica)
+            return async_session_maker
+
+        monkeypatch.setattr(config, "DB_READ_FROM_REPLICA", True)
+        monkeypatch.setattr(crud_ops, "get_read_session_maker", get_read_session_maker)
+        response_cache.post_cache.invalidate(post_id)
+        assert requests.get(f"{url}/post/{post_id}").status_code == 200
+        assert routed == [False]
+
+    def test_password_executor_overloaded(self, url, su_token, in_process, monkeypatch):
+        import db.passwords
+
+        overloaded = db.passwords.PasswordExecutor("thread", workers=1, max_queue=0)
+        monkeypatch.setattr(db.passwords, "_executor", overloaded)
+        credentials = {"email": "busy@user.com", "password": "Busy1234pass"}
+
+        response = auth_request(
+            url, su_token, "post", "user", {**credentials, "group_id": 2}
+        )
+        assert response.status_code == 503
+        response = auth_request(
+            url, su_token, "post", "users", [{**credentials, "group_id": 2}]
+        )
+        assert response.status_code == 503
+        response = request_user_token(url)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+        overloaded.shutdown()
+
+    def test_token_and_patch_reads_stay_on_the_primary(
+        self, url, in_process, monkeypatch
+    ):
+        import config
+        from db import crud_ops
+
+        token = request_user_token(url).json()["token"]
+        post_id = auth_request(
+            url, token, "post", "post", {"title": "t", "text": "t"}
+        ).json()["id"]
+        token = request_user_token(url).json()["token"]
+        routed = []
+
+        def get_read_session_maker(async_session_maker, readonly, replica):
+            routed.append(replica)
+            return async_session_maker
+
+        monkeypatch.setattr(config, "DB_READ_FROM_REPLICA", True)
+        monkeypatch.setattr(crud_ops, "get_read_session_maker", get_read_session_maker)
+        response = auth_request(url, token, "patch", f"post/{post_id}", {"text": "x"})
+        assert response.status_code == 200
+        assert routed and not any(routed)
+
+        routed.clear()
+        assert requests.get(f"{url}/post", params={"limit": 1}).status_code == 200
+        assert routed == [True]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import config
+from app.app import database_context
+from db import migrations
+from db.db_models import Group, schema_version
+from db.sessions import create_engine, get_async_session, warm_pool
+
+
+def sqlite_dsn(tmp_path, name="db"):
+    return f"sqlite+aiosqlite:///{tmp_path / name}"
+
+
+def test_migrations_apply_twice(tmp_path):
+    dsn = sqlite_dsn(tmp_path)
+
+    async def scenario():
+        assert await migrations.migrate(dsn) == migrations.SCHEMA_VERSION
+        async with get_async_session(dsn) as async_session_maker:
+            async with async_session_maker() as session:
+                async with session.begin():
+                    session.add(Group(name="kept"))
+                    await session.execute(update(schema_version).values(version=0))
+        assert await migrations.migrate(dsn) == migrations.SCHEMA_VERSION
+        assert await migrations.migrate(dsn) == migrations.SCHEMA_VERSION
+        async with get_async_session(dsn) as async_session_maker:
+            async with async_session_maker() as session:
+                versions = (await session.execute(select(schema_version))).all()
+                groups = (await session.execute(select(Group.name))).scalars().all()
+            checked = await migrations.check_schema_version(async_session_maker)
+        return versions, groups, checked
+
+    versions, groups, checked = asyncio.run(scenario())
+    assert [tuple(row) for row in versions] == [(migrations.SCHEMA_VERSION,)]
+    assert groups == ["kept"]
+    assert checked == migrations.SCHEMA_VERSION
+
+
+def test_schema_mismatch_refuses_boot(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DB", sqlite_dsn(tmp_path))
+
+    async def boot():
+        context = database_context(web.Application())
+        await context.__anext__()
+
+    async def rewind():
+        async with get_async_session(config.DB) as async_session_maker:
+            async with async_session_maker() as session:
+                async with session.begin():
+                    version = migrations.SCHEMA_VERSION - 1
+                    await session.execute(
+                        update(schema_version).values(version=version)
+                    )
+
+    with pytest.raises(migrations.SchemaMismatch, match="version None"):
+        asyncio.run(boot())
+    asyncio.run(migrations.migrate(config.DB))
+    asyncio.run(rewind())
+    with pytest.raises(migrations.SchemaMismatch, match="run python -m db.migrations"):
+        asyncio.run(boot())
+
+
+def test_warm_pool_opens_connections_up_to_pool_size(tmp_path):
+    async def scenario():
+        engine = create_async_engine(
+            sqlite_dsn(tmp_path), poolclass=AsyncAdaptedQueuePool, pool_size=3
+        )
+        try:
+            assert await warm_pool(engine, 2) == 2
+            assert engine.sync_engine.pool.checkedin() == 2
+            assert await warm_pool(engine, 10) == 3
+            assert engine.sync_engine.pool.checkedin() == 3
+            assert engine.sync_engine.pool.checkedout() == 0
+        finally:
+            await engine.dispose()
+
+        engine = create_engine(sqlite_dsn(tmp_path))
+        try:
+            assert await warm_pool(engine, 5) == 0
+        finally:
+            await engine.dispose()
+
+        engine = create_async_engine(
+            sqlite_dsn(tmp_path / "missing"), poolclass=AsyncAdaptedQueuePool
+        )
+        try:
+            with pytest.raises(OperationalError):
+                await warm_pool(engine, 2)
+            assert engine.sync_engine.pool.checkedout() == 0
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,24 @@
+import asyncio
+
+import asyncpg
+import pytest
+
+import config
+import db.notifications
+
+
+def test_listener_retries_on_any_error(monkeypatch):
+    errors = [asyncpg.InterfaceError("gone"), asyncio.TimeoutError(), ValueError()]
+    attempts = []
+
+    async def connect(*args, **kwargs):
+        attempts.append(args)
+        if errors:
+            raise errors.pop(0)
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(db.notifications.asyncpg, "connect", connect)
+    monkeypatch.setattr(config, "NOTIFY_RECONNECT_DELAY", 0)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(db.notifications.listen("postgresql+asyncpg://db/app", {}))
+    assert len(attempts) == 4
@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+import pytest
+
+from db.passwords import ExecutorOverloaded, PasswordExecutor
+
+
+def test_executor_queue_is_bounded():
+    release = threading.Event()
+
+    async def scenario():
+        executor = PasswordExecutor("thread", workers=1, max_queue=1)
+        try:
+            running = asyncio.ensure_future(executor.run(release.wait))
+            queued = asyncio.ensure_future(executor.run(release.wait))
+            while not executor.in_flight:
+                await asyncio.sleep(0.01)
+            assert executor.stats["in_flight"] == 1
+            assert executor.stats["queued"] == 1
+
+            with pytest.raises(ExecutorOverloaded):
+                await executor.run(release.wait)
+            assert executor.stats["queued"] == 1
+
+            release.set()
+            assert await asyncio.gather(running, queued) == [True, True]
+            return executor.stats
+        finally:
+            release.set()
+            executor.shutdown()
+
+    stats = asyncio.run(scenario())
+    assert stats["in_flight"] == 0
+    assert stats["queued"] == 0
@@ -0,0 +1,39 @@
+import asyncio
+
+from db.db_models import User as UserRow
+from db.models import Post, User
+from db import privileges
+from db.privileges import RIGHT_BITS, group_masks
+
+
+def test_user_keeps_privileges_loaded_for_request():
+    group_masks[1] = RIGHT_BITS[("post", "write", "all")]
+    user = User(UserRow(id=1, group_id=1), privileges=group_masks[1])
+    group_masks.clear()
+    assert user.has_access(Post(owner_id=2), "write")
+    assert not User(UserRow(id=1, group_id=1)).has_access(Post(owner_id=2), "write")
+
+
+def test_mask_invalidated_while_loading_is_not_cached(monkeypatch):
+    async def scenario(invalidate):
+        group_masks.clear()
+        loaded = asyncio.Event()
+
+        async def query_group_mask(group_id, async_session_maker):
+            await loaded.wait()
+            return RIGHT_BITS[("post", "write", "all")]
+
+        monkeypatch.setattr(privileges, "query_group_mask", query_group_mask)
+        load = asyncio.ensure_future(privileges.load_group_mask(1, None))
+        await asyncio.sleep(0)
+        invalidate()
+        loaded.set()
+        assert await load == RIGHT_BITS[("post", "write", "all")]
+        return group_masks.get(1)
+
+    assert asyncio.run(scenario(lambda: None)) is not None
+    assert asyncio.run(scenario(lambda: privileges.invalidate_group(1))) is None
+    assert asyncio.run(scenario(lambda: privileges.invalidate_group())) is None
+    assert asyncio.run(scenario(lambda: privileges.invalidate_group(2))) is not None
+    assert not privileges.mask_loads.loads
+    group_masks.clear()
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import pstats
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import event
+
+import config
+from app import profiling
+from app.app import database_context, get_app
+from db.migrations import migrate
+
+
+def test_profiled_request_writes_a_profile(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path))
+
+    async def scenario():
+        async def hello(request):
+            return web.json_response({})
+
+        app = web.Application(middlewares=[profiling.middleware])
+        app.router.add_get("/hello/{name}", hello)
+        async with TestClient(TestServer(app)) as client:
+            assert (await client.get("/hello/a")).status == 200
+            headers = {profiling.PROFILE_HEADER: "wrong"}
+            assert (await client.get("/hello/a", headers=headers)).status == 200
+            assert not os.listdir(tmp_path)
+            headers = {profiling.PROFILE_HEADER: "secret"}
+            assert (await client.get("/hello/a", headers=headers)).status == 200
+
+    asyncio.run(scenario())
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1
+    assert f"-GET-hello_name-{os.getpid()}.prof" in profiles[0]
+    pstats.Stats(str(tmp_path / profiles[0]))
+
+
+def test_profiling_is_off_by_default(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(config, "PROFILE_TOKEN", None)
+    monkeypatch.setattr(config, "SLOW_QUERY_SECONDS", 0)
+    monkeypatch.setattr(config, "DB", f"sqlite+aiosqlite:///{tmp_path / 'db'}")
+
+    async def listens_for_slow_queries():
+        app = web.Application()
+        context = database_context(app)
+        await context.__anext__()
+        try:
+            return [
+                event.contains(
+                    engine.sync_engine,
+                    "after_cursor_execute",
+                    profiling._after_cursor_execute,
+                )
+                for engine in app["async_session_maker"].engines
+            ]
+        finally:
+            async for _ in context:
+                pass
+
+    async def installs_middleware():
+        app = await get_app()
+        return profiling.middleware in app.middlewares
+
+    asyncio.run(migrate(config.DB))
+    assert not profiling.profiling_enabled()
+    assert not asyncio.run(installs_middleware())
+    assert asyncio.run(listens_for_slow_queries()) == [False]
+
+    monkeypatch.setattr(config, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(config, "SLOW_QUERY_SECONDS", 0.5)
+    assert asyncio.run(installs_middleware())
+    assert asyncio.run(listens_for_slow_queries()) == [True]
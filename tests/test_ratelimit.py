@@ -0,0 +1,18 @@
+from app.ratelimit import TokenBuckets
+
+
+def test_token_buckets_reject_when_empty():
+    buckets = TokenBuckets(rate=1, burst=2, max_size=10)
+    assert buckets.take("a") == 0
+    assert buckets.take("a") == 0
+    assert 0 < buckets.take("a") <= 1
+    assert buckets.stats["rejected"] == 1
+
+
+def test_token_buckets_evict_least_recently_used():
+    buckets = TokenBuckets(rate=1, burst=1, max_size=2)
+    buckets.take("a")
+    buckets.take("b")
+    buckets.take("a")
+    buckets.take("c")
+    assert list(buckets.buckets) == ["a", "c"]
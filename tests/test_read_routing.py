@@ -0,0 +1,47 @@
+import asyncio
+import os
+import tempfile
+
+import config
+from db.crud_ops import get_read_session
+from db.sessions import get_async_session
+
+
+def test_read_session_routing(monkeypatch):
+    directory = tempfile.mkdtemp()
+    primary = f"sqlite+aiosqlite:///{os.path.join(directory, 'primary.db')}"
+    replica = f"sqlite+aiosqlite:///{os.path.join(directory, 'replica.db')}"
+
+    async def routes(calls):
+        async with get_async_session(
+            primary, create=True, replica_dsn=replica
+        ) as async_session_maker:
+            readers = {
+                reader.kw["bind"]: key
+                for key, reader in async_session_maker.readers.items()
+            }
+            picked = []
+            for flags in calls:
+                async with get_read_session(async_session_maker, **flags) as session:
+                    picked.append(readers[session.bind])
+            return picked
+
+    monkeypatch.setattr(config, "DB_READONLY_READS", True)
+    monkeypatch.setattr(config, "DB_READ_FROM_REPLICA", True)
+    assert asyncio.run(
+        routes(
+            [
+                {},
+                {"replica": False},
+                {"readonly": False},
+                {"readonly": False, "replica": False},
+            ]
+        )
+    ) == [(True, True), (True, False), (False, True), (False, False)]
+
+    monkeypatch.setattr(config, "DB_READONLY_READS", False)
+    monkeypatch.setattr(config, "DB_READ_FROM_REPLICA", False)
+    assert asyncio.run(routes([{}, {"readonly": True, "replica": True}])) == [
+        (False, False),
+        (True, True),
+    ]
@@ -0,0 +1,44 @@
+import asyncio
+
+from app.response_cache import ResponseCache
+
+
+def load_after(event: asyncio.Event, data: dict):
+    async def load():
+        await event.wait()
+        return data, data["version"]
+
+    return load
+
+
+def test_load_is_cached():
+    async def scenario():
+        loaded = asyncio.Event()
+        loaded.set()
+        return await cache.get_or_load(1, load_after(loaded, {"version": 1}))
+
+    cache = ResponseCache(max_size=10, ttl=60)
+    cached = asyncio.run(scenario())
+    assert cached.etag == '"1"'
+    assert cache.get(1) is cached
+    assert not cache.loads
+
+
+def test_load_invalidated_in_flight_is_not_cached():
+    async def scenario(invalidate):
+        cache = ResponseCache(max_size=10, ttl=60)
+        loaded = asyncio.Event()
+        pending = asyncio.ensure_future(
+            cache.get_or_load(1, load_after(loaded, {"version": 1}))
+        )
+        await asyncio.sleep(0)
+        invalidate(cache)
+        loaded.set()
+        cached = await pending
+        return cache, cached
+
+    for invalidate in (lambda cache: cache.invalidate(1), ResponseCache.clear):
+        cache, cached = asyncio.run(scenario(invalidate))
+        assert cached.etag == '"1"'
+        assert cache.get(1) is None
+        assert not cache.loads
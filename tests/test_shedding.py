@@ -0,0 +1,212 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+from app import shedding
+from app.shedding import AdmissionQueue, Overloaded
+from db.sessions import PoolWaitStats
+
+
+async def queued(queue: AdmissionQueue, count: int):
+    tasks = [asyncio.ensure_future(queue.acquire()) for _ in range(count)]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_queue_overflow_is_rejected():
+    async def scenario():
+        queue = AdmissionQueue(limit=1, max_queue=1, timeout=1)
+        await queue.acquire()
+        tasks = await queued(queue, 1)
+        with pytest.raises(Overloaded):
+            await queue.acquire()
+        with pytest.raises(Overloaded):
+            await queue.acquire(queue=False)
+        queue.release()
+        await asyncio.gather(*tasks)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.stats["rejected"] == 2
+    assert queue.stats["active"] == 1
+
+
+def test_release_hands_the_slot_over_in_order():
+    async def scenario():
+        queue = AdmissionQueue(limit=1, max_queue=2, timeout=1)
+        await queue.acquire()
+        first, second = await queued(queue, 2)
+        assert queue.stats["queued"] == 2
+
+        queue.release()
+        await first
+        assert not second.done()
+        assert queue.active == 1
+
+        queue.release()
+        await second
+        assert queue.active == 1
+
+        queue.release()
+        assert queue.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiter_times_out():
+    async def scenario():
+        queue = AdmissionQueue(limit=1, max_queue=1, timeout=0.01)
+        await queue.acquire()
+        with pytest.raises(Overloaded):
+            await queue.acquire()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.stats["timed_out"] == 1
+    assert queue.stats["queued"] == 0
+    assert queue.active == 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        queue = AdmissionQueue(limit=1, max_queue=2, timeout=1)
+        await queue.acquire()
+        first, second = await queued(queue, 2)
+        first.cancel()
+        await asyncio.wait((first,))
+        assert queue.stats["queued"] == 1
+
+        queue.release()
+        await second
+        assert first.cancelled()
+        assert queue.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_slot_handed_to_a_cancelled_waiter_passes_on():
+    async def scenario():
+        queue = AdmissionQueue(limit=1, max_queue=2, timeout=1)
+        await queue.acquire()
+        first, second = await queued(queue, 2)
+        queue.release()
+        first.cancel()
+        await second
+        assert first.cancelled()
+        assert queue.active == 1
+
+        queue.release()
+        assert queue.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_middleware_sheds_with_retry_after(monkeypatch):
+    monkeypatch.setattr(config, "SHED_POOL_WAIT", 0)
+    monkeypatch.setattr(
+        shedding,
+        "queues",
+        {name: AdmissionQueue(1, 0, 2) for name in ("auth", "reads", "writes")},
+    )
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow(request):
+            await release.wait()
+            return web.json_response({})
+
+        async def health(request):
+            return web.json_response({})
+
+        app = web.Application(middlewares=[shedding.middleware])
+        app.router.add_get("/slow", slow)
+        app.router.add_get("/health", health)
+        async with TestClient(TestServer(app)) as client:
+            in_flight = asyncio.ensure_future(client.get("/slow"))
+            while not shedding.queues["reads"].active:
+                await asyncio.sleep(0.01)
+
+            shed = await client.get("/slow")
+            assert shed.status == 503
+            assert shed.headers["Retry-After"] == "2"
+            assert (await shed.json())["error"]
+            assert (await client.get("/health")).status == 200
+
+            release.set()
+            assert (await in_flight).status == 200
+        assert shedding.queues["reads"].active == 0
+
+    asyncio.run(scenario())
+
+
+def test_pool_wait_counts_blocked_and_failed_acquisitions():
+    async def scenario():
+        stats = PoolWaitStats(decay=0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            with stats.waiting():
+                await asyncio.wait_for(asyncio.Event().wait(), 0.05)
+        assert stats.stats["waits_failed"] == 1
+        assert stats.max >= 0.05
+
+        stalled = asyncio.Event()
+
+        async def acquire():
+            with stats.waiting():
+                await stalled.wait()
+
+        blocked = asyncio.ensure_future(acquire())
+        await asyncio.sleep(0.1)
+        # the completed wait has decayed away, the blocked one keeps growing
+        assert stats.recent_completed() < 0.01
+        assert stats.recent() >= 0.1
+        assert stats.stats["waiting"] == 1
+        stalled.set()
+        await blocked
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats.stats["waiting"] == 0
+    assert stats.count == 2
+
+
+def test_middleware_keeps_shedding_while_the_pool_is_stalled(monkeypatch):
+    stats = PoolWaitStats()
+    monkeypatch.setattr(shedding, "pool_wait", stats)
+    monkeypatch.setattr(config, "SHED_POOL_WAIT", 0.05)
+    monkeypatch.setattr(
+        shedding,
+        "queues",
+        {name: AdmissionQueue(1, 10, 5) for name in ("auth", "reads", "writes")},
+    )
+
+    async def scenario():
+        stalled = asyncio.Event()
+
+        async def query(request):
+            with stats.waiting():
+                await stalled.wait()
+            return web.json_response({})
+
+        app = web.Application(middlewares=[shedding.middleware])
+        app.router.add_get("/query", query)
+        async with TestClient(TestServer(app)) as client:
+            in_flight = asyncio.ensure_future(client.get("/query"))
+            while not stats.pending:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+
+            for _ in range(3):
+                shed = await asyncio.wait_for(client.get("/query"), 1)
+                assert shed.status == 503
+                assert "Retry-After" in shed.headers
+                await asyncio.sleep(0.1)
+            assert shedding.queues["reads"].stats["queued"] == 0
+
+            stalled.set()
+            assert (await in_flight).status == 200
+
+    asyncio.run(scenario())
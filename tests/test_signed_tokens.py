@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+import config
+from app import signed_tokens
+from db.db_models import User
+
+
+@pytest.fixture(autouse=True)
+def keys(monkeypatch):
+    monkeypatch.setattr(config, "TOKEN_KEYS", {"k1": "new secret", "k0": "old secret"})
+    monkeypatch.setattr(config, "TOKEN_KEY_ID", "k1")
+    monkeypatch.setattr(signed_tokens, "deny_list", signed_tokens.DenyList(2))
+
+
+def test_issue_and_verify():
+    token = signed_tokens.issue(User(id=7, group_id=2))
+    verified = signed_tokens.verify(token)
+    assert verified.key_id == "k1"
+    assert (verified.user_id, verified.group_id) == (7, 2)
+    assert not verified.is_expired
+
+
+def test_forged_signature_is_rejected():
+    key_id, payload, signature = signed_tokens.issue(User(id=7, group_id=2)).split(".")
+    forged_payload = signed_tokens._encode(f"1:1:{int(time.time())}".encode())
+    assert signed_tokens.verify(f"{key_id}.{forged_payload}.{signature}") is None
+    assert signed_tokens.verify(f"{key_id}.{payload}.{signature[:-2]}AA") is None
+    assert signed_tokens.verify(f"nokey.{payload}.{signature}") is None
+    assert signed_tokens.verify(f"{key_id}.{payload}.\xe9") is None
+    assert signed_tokens.verify(f"{key_id}.{payload}.{signature[:-1]}\xe9") is None
+    assert signed_tokens.verify("not-a-token") is None
+
+
+def test_rotated_key_verifies_until_removed(monkeypatch):
+    monkeypatch.setattr(config, "TOKEN_KEY_ID", "k0")
+    token = signed_tokens.issue(User(id=7, group_id=None))
+    monkeypatch.setattr(config, "TOKEN_KEY_ID", "k1")
+    assert signed_tokens.verify(token).group_id is None
+    monkeypatch.setattr(config, "TOKEN_KEYS", {"k1": "new secret"})
+    assert signed_tokens.verify(token) is None
+
+
+def test_revoked_token_is_rejected():
+    token = signed_tokens.verify(signed_tokens.issue(User(id=7, group_id=2)))
+    signed_tokens.revoke(token)
+    assert signed_tokens.verify(token.token) is None
+
+
+def test_full_deny_list_refuses_instead_of_evicting():
+    tokens = [
+        signed_tokens.verify(signed_tokens.issue(User(id=user_id, group_id=2)))
+        for user_id in range(3)
+    ]
+    signed_tokens.revoke(tokens[0])
+    signed_tokens.revoke(tokens[1])
+    with pytest.raises(signed_tokens.DenyListFull):
+        signed_tokens.revoke(tokens[2])
+    assert signed_tokens.verify(tokens[0].token) is None
+
+    signed_tokens.revoke_noticed(signed_tokens.notice(tokens[2]))
+    assert all(signed_tokens.verify(token.token) is None for token in tokens)
+
+
+def test_expired_entries_make_room():
+    signed_tokens.deny_list.add("a", time.time() - 1)
+    signed_tokens.deny_list.add("b", time.time() + 60)
+    assert signed_tokens.deny_list.add("c", time.time() + 60)
+    assert "a" not in signed_tokens.deny_list.entries
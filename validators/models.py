@@ -3,6 +3,7 @@ import typing
 
 import pydantic
 
+import config
 from db.db_models import AccessRight, AccessObject, AccessScope
 
 STRONG_PASSWORD = re.compile(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)[a-zA-Z\d]{8,}$")
@@ -59,6 +60,12 @@ class PostUpdate(pydantic.BaseModel):
         return values
 
 
+class PostList(pydantic.BaseModel):
+    after: typing.Optional[pydantic.conint(ge=0)] = None
+    limit: pydantic.conint(ge=1, le=config.PAGE_SIZE_MAX) = config.PAGE_SIZE
+    owner_id: typing.Optional[int] = None
+
+
 VALIDATOR = typing.Union[
-    UserCreate, Login, ObjectId, RightCreate, PostCreate, PostUpdate
+    UserCreate, Login, ObjectId, RightCreate, PostCreate, PostUpdate, PostList
 ]